@@ -1,4 +1,5 @@
 import numpy as np
+from collections import Counter, namedtuple
 from scipy.special import betaln, comb, beta as beta_func
 from .binom_funcs import binom_pmf, binom_log_pmf, \
                          betabinom_pmf, betabinom_log_pmf
@@ -8,11 +9,62 @@ __all__ = ['BinomialEv', 'BinomialStmt', 'BetaBinomialEv', 'BetaBinomialStmt',
            'OrigBeliefEv', 'OrigBeliefStmt']
 
 
+# Curation data compiled into arrays: each row is a distinct
+# (num_ev, num_correct) cell with the number of curated statements in it
+# (count). num_groups is the number of distinct evidence counts in the
+# original data, used to scale weighted likelihoods.
+CountTable = namedtuple('CountTable',
+                        ['num_ev', 'num_correct', 'count', 'num_groups'])
+
+
+def count_table(correct_by_num_ev):
+    """Compile a dict of correct counts keyed by number of evidences into a
+    CountTable. A CountTable is returned as is."""
+    if isinstance(correct_by_num_ev, CountTable):
+        return correct_by_num_ev
+    cells = Counter((num_ev, num_correct)
+                    for num_ev, num_corrects in correct_by_num_ev.items()
+                    for num_correct in num_corrects)
+    cells = sorted(cells.items())
+    num_ev = np.array([n for (n, _), _ in cells], dtype=int)
+    num_correct = np.array([k for (_, k), _ in cells], dtype=int)
+    count = np.array([c for _, c in cells], dtype=float)
+    return CountTable(num_ev, num_correct, count, len(correct_by_num_ev))
+
+
+def _num_ev_array(num_evs):
+    # Numbers of evidences can be given as any iterable, e.g., dict keys
+    if isinstance(num_evs, np.ndarray):
+        return num_evs
+    return np.array(list(num_evs))
+
+
 class BeliefModel(object):
     def __init__(self, param_names, weights):
         self.param_names = param_names
         self.weights = weights
 
+    @staticmethod
+    def walker_params(params):
+        """Return the parameters as arrays with a trailing axis so that they
+        broadcast against the cells of a CountTable.
+
+        Each parameter can be a scalar or an array of values, one per
+        walker, in which case the likelihood is evaluated for all walkers at
+        once.
+        """
+        return [np.asarray(p, dtype=float)[..., np.newaxis] for p in params]
+
+    def sum_log_likelihood(self, ll_cells, counts):
+        """Sum the log likelihoods of the cells of a CountTable, accounting
+        for the multiplicity of each cell and, if the model has weights,
+        the weight of the cell's number of evidences."""
+        ll_cells = ll_cells * counts.count
+        if self.weights:
+            row_weights = np.array([self.weights[n] for n in counts.num_ev])
+            ll_cells = ll_cells * row_weights * counts.num_groups
+        return np.sum(ll_cells, axis=-1)
+
     def log_prior(self, params, args):
         raise NotImplementedError()
 
@@ -41,47 +93,22 @@ class Binomial(BeliefModel):
         super(Binomial, self).__init__('p', weights)
 
     def log_prior(self, params, args):
-        p = params[0]
-        if p < 0:
-            return -np.inf
-        elif p > 1:
-            return - np.inf
-        else:
-            return 0
+        p = np.asarray(params[0])
+        return np.where((p < 0) | (p > 1), -np.inf, 0.0)[()]
 
     def log_likelihood_ev(self, params, correct_by_num_ev, args):
-        p = params[0]
-        ll = 0
-        for num_ev, num_corrects in correct_by_num_ev.items():
-            n = num_ev
-            ll_n = 0
-            for num_correct in num_corrects:
-                k = num_correct
-                ll_n += binom_log_pmf(k, n, p)
-            if self.weights:
-                ll += self.weights[num_ev] * ll_n * len(correct_by_num_ev)
-            else:
-                ll += ll_n
-        return ll
+        p = self.walker_params(params)[0]
+        counts = count_table(correct_by_num_ev)
+        ll_cells = binom_log_pmf(counts.num_correct, counts.num_ev, p)
+        return self.sum_log_likelihood(ll_cells, counts)
 
     def log_likelihood_stmt(self, params, correct_by_num_ev, args):
-        p = params[0]
-        ll = 0
-        for num_ev, num_corrects in correct_by_num_ev.items():
-            n = num_ev
-            ll_n = 0
-            for num_correct in num_corrects:
-                prob_zero = binom_pmf(0, num_ev, p)
-                prob_non_zero = 1 - prob_zero
-                if num_correct == 0:
-                    ll_n += np.log(prob_zero)
-                else:
-                    ll_n += np.log(prob_non_zero)
-            if self.weights:
-                ll += self.weights[num_ev] * ll_n * len(correct_by_num_ev)
-            else:
-                ll += ll_n
-        return ll
+        p = self.walker_params(params)[0]
+        counts = count_table(correct_by_num_ev)
+        prob_zero = binom_pmf(0, counts.num_ev, p)
+        ll_cells = np.log(np.where(counts.num_correct == 0,
+                                   prob_zero, 1 - prob_zero))
+        return self.sum_log_likelihood(ll_cells, counts)
 
     def sample_prior(self):
         return np.random.random(size=1)
@@ -90,19 +117,13 @@ class Binomial(BeliefModel):
         # Return the vector of probabilities of exactly 0 <= k <= n evidences
         # correct
         p = params[0]
-        probs = []
-        for k in range(0, n+1):
-            probs.append(binom_pmf(k, n, p))
-        return probs
+        return binom_pmf(np.arange(n+1), n, p)
 
     def stmt_predictions(self, params, num_evs):
         # Return the vector of probabilities correctness for statements with
         # different numbers of evidences
         p = params[0]
-        probs = []
-        for num_ev in num_evs:
-            probs.append(1 - binom_pmf(0, num_ev, p))
-        return probs
+        return 1 - binom_pmf(0, _num_ev_array(num_evs), p)
 
 
 class BinomialStmt(Binomial):
@@ -122,14 +143,11 @@ class BetaBinomial(BeliefModel):
 
     def log_prior(self, params, args):
         # alpha and beta are positive real numbers
-        alpha, beta = params
-        if alpha < 0 or beta < 0:
-            return -np.inf
+        alpha, beta = np.asarray(params[0]), np.asarray(params[1])
+        out_of_bounds = (alpha < 0) | (beta < 0)
         # FIXME: Restricting to < 1 due to NaN
-        #elif alpha > 1 or beta > 1:
-        #    return -np.inf
-        else:
-            return 0
+        #out_of_bounds |= (alpha > 1) | (beta > 1)
+        return np.where(out_of_bounds, -np.inf, 0.0)[()]
 
     def _log_lkl_k_ev(self, k, n, alpha, beta):
         b1 = betaln(k + alpha, n - k + beta)
@@ -143,36 +161,19 @@ class BetaBinomial(BeliefModel):
         return comb(n, k) * b1 / b2
 
     def log_likelihood_ev(self, params, correct_by_num_ev, args):
-        ll = 0
-        alpha, beta = params
-        for num_ev, num_corrects in correct_by_num_ev.items():
-            ll_n = 0
-            for num_correct in num_corrects:
-                #ll += self._log_lkl_k_ev(num_correct, num_ev, alpha, beta)
-                ll_n += betabinom_log_pmf(num_correct, num_ev, alpha, beta)
-            if self.weights:
-                ll += self.weights[num_ev] * ll_n * len(correct_by_num_ev)
-            else:
-                ll += ll_n
-        return ll
+        alpha, beta = self.walker_params(params)
+        counts = count_table(correct_by_num_ev)
+        ll_cells = betabinom_log_pmf(counts.num_correct, counts.num_ev,
+                                     alpha, beta)
+        return self.sum_log_likelihood(ll_cells, counts)
 
     def log_likelihood_stmt(self, params, correct_by_num_ev, args):
-        ll = 0
-        alpha, beta = params
-        for num_ev, num_corrects in correct_by_num_ev.items():
-            ll_n = 0
-            for num_correct in num_corrects:
-                #prob_zero = self._lkl_k_ev(0, num_ev, alpha, beta)
-                prob_zero = betabinom_pmf(0, num_ev, alpha, beta)
-                if num_correct == 0:
-                    ll_n += np.log(prob_zero)
-                else:
-                    ll_n += np.log(1 - prob_zero)
-            if self.weights:
-                ll += self.weights[num_ev] * ll_n * len(correct_by_num_ev)
-            else:
-                ll += ll_n
-        return ll
+        alpha, beta = self.walker_params(params)
+        counts = count_table(correct_by_num_ev)
+        prob_zero = betabinom_pmf(0, counts.num_ev, alpha, beta)
+        ll_cells = np.log(np.where(counts.num_correct == 0,
+                                   prob_zero, 1 - prob_zero))
+        return self.sum_log_likelihood(ll_cells, counts)
 
     def sample_prior(self):
         # alpha and beta are positive real numbers--can scale to random reals
@@ -183,22 +184,16 @@ class BetaBinomial(BeliefModel):
         # Return the vector of probabilities of exactly 0 <= k <= n evidences
         # correct
         alpha, beta = params
-        probs = []
-        for k in range(0, n+1):
-            #probs.append(self._lkl_k_ev(k, n, alpha, beta))
-            probs.append(betabinom_pmf(k, n, alpha, beta))
-        return probs
+        #return self._lkl_k_ev(np.arange(n+1), n, alpha, beta)
+        return betabinom_pmf(np.arange(n+1), n, alpha, beta)
 
     def stmt_predictions(self, params, num_evs):
         # Return the vector of probabilities correctness for statements with
         # different numbers of evidences from 1 to max_n
         alpha, beta = params
-        probs = []
-        for num_ev in num_evs:
-            #prob_zero = self._lkl_k_ev(0, num_ev, alpha, beta)
-            prob_zero = betabinom_pmf(0, num_ev, alpha, beta)
-            probs.append(1 - prob_zero)
-        return probs
+        #prob_zero = self._lkl_k_ev(0, num_evs, alpha, beta)
+        prob_zero = betabinom_pmf(0, _num_ev_array(num_evs), alpha, beta)
+        return 1 - prob_zero
 
 
 class BetaBinomialStmt(BetaBinomial):
@@ -217,12 +212,10 @@ class OrigBelief(BeliefModel):
         super(OrigBelief, self).__init__(['Rand', 'Syst'], weights)
 
     def log_prior(self, params, args):
-        pr, ps = params
+        pr, ps = np.asarray(params[0]), np.asarray(params[1])
         # Uniform prior over [0, 1]
-        if pr < 0 or ps < 0 or pr > 1 or ps > 1:
-            return -np.inf
-        else:
-            return 0
+        out_of_bounds = (pr < 0) | (ps < 0) | (pr > 1) | (ps > 1)
+        return np.where(out_of_bounds, -np.inf, 0.0)[()]
 
     @staticmethod
     def belief(num_ev, pr, ps):
@@ -230,37 +223,20 @@ class OrigBelief(BeliefModel):
         return b
 
     def log_likelihood_ev(self, params, correct_by_num_ev, args):
-        pr, ps = params
-        ll = 0
-        for num_ev, num_corrects in correct_by_num_ev.items():
-            ll_n = 0
-            for num_correct in num_corrects:
-                if num_correct == 0:
-                    ll_n += np.log(ps + (1-ps) * binom_pmf(0, num_ev, 1-pr))
-                else:
-                    ll_n += np.log((1-ps) * binom_pmf(num_correct,
-                                                      num_ev, 1-pr))
-            if self.weights:
-                ll += self.weights[num_ev] * ll_n * len(correct_by_num_ev)
-            else:
-                ll += ll_n
-        return ll
+        pr, ps = self.walker_params(params)
+        counts = count_table(correct_by_num_ev)
+        # The probability of zero correct includes the systematic error
+        lkl_cells = (1-ps) * binom_pmf(counts.num_correct, counts.num_ev, 1-pr)
+        lkl_cells = np.where(counts.num_correct == 0, ps + lkl_cells,
+                             lkl_cells)
+        return self.sum_log_likelihood(np.log(lkl_cells), counts)
 
     def log_likelihood_stmt(self, params, correct_by_num_ev, args):
-        pr, ps = params
-        ll = 0
-        for num_ev, num_corrects in correct_by_num_ev.items():
-            ll_n = 0
-            for num_correct in num_corrects:
-                if num_correct == 0:
-                    ll_n += np.log(1 - self.belief(num_ev, pr, ps))
-                else:
-                    ll_n += np.log(self.belief(num_ev, pr, ps))
-            if self.weights:
-                ll += self.weights[num_ev] * ll_n * len(correct_by_num_ev)
-            else:
-                ll += ll_n
-        return ll
+        pr, ps = self.walker_params(params)
+        counts = count_table(correct_by_num_ev)
+        b = self.belief(counts.num_ev, pr, ps)
+        ll_cells = np.log(np.where(counts.num_correct == 0, 1 - b, b))
+        return self.sum_log_likelihood(ll_cells, counts)
 
     def sample_prior(self):
         # pr and ps are between [0, 1)
@@ -269,23 +245,16 @@ class OrigBelief(BeliefModel):
     def ev_predictions(self, params, n):
         """Return log likelihood of belief model parameters given data."""
         pr, ps = params
-        probs = []
-        for k in range(0, n+1):
-            if k == 0:
-                ll = ps + (1-ps) * binom_pmf(0, n, 1-pr)
-            else:
-                ll = (1-ps) * binom_pmf(k, n, 1-pr)
-            probs.append(ll)
+        probs = (1-ps) * binom_pmf(np.arange(n+1), n, 1-pr)
+        # The probability of zero correct includes the systematic error
+        probs[0] += ps
         return probs
 
     def stmt_predictions(self, params, num_evs):
         # Return the vector of probabilities correctness for statements with
         # different numbers of evidences from 1 to max_n
         pr, ps = params
-        probs = []
-        for num_ev in num_evs:
-            probs.append(self.belief(num_ev, pr, ps))
-        return probs
+        return self.belief(_num_ev_array(num_evs), pr, ps)
 
 # ORIGINAL BELIEF MODEL by evidence -------------------------------------
 
@@ -1,24 +1,63 @@
+"""Binomial and beta-binomial probability functions.
+
+All functions accept numpy arrays (or scalars) for each of their arguments
+and broadcast them against each other like numpy ufuncs. Log binomial
+coefficients for integer arguments up to a maximum n are looked up in a
+precomputed table, see set_log_comb_max_n.
+"""
 import numpy as np
-from scipy.special import betaln, comb, loggamma, beta as beta_func
+from scipy.special import loggamma, xlogy, xlog1py
 
 
 def log_binom(n, k):
     return loggamma(n+1) - loggamma(k+1) - loggamma(n-k+1)
 
 
+def _make_log_comb_table(max_n):
+    n = np.arange(max_n + 1)[:, np.newaxis]
+    k = np.arange(max_n + 1)[np.newaxis, :]
+    with np.errstate(invalid='ignore'):
+        table = log_binom(n, k)
+    # There are no ways of choosing more than n elements
+    return np.where(k <= n, table, -np.inf)
+
+
+# Table of log(n choose k) for 0 <= n, k <= max_n
+_log_comb_table = _make_log_comb_table(100)
+
+
+def set_log_comb_max_n(max_n):
+    """Set the maximum n for which log binomial coefficients are tabulated.
+
+    Coefficients for larger n (or non-integer arguments) are computed with
+    log_binom instead.
+    """
+    global _log_comb_table
+    _log_comb_table = _make_log_comb_table(max_n)
+
+
+def log_comb(n, k):
+    """Return log(n choose k) from the table if possible."""
+    n, k = np.asarray(n), np.asarray(k)
+    if n.dtype.kind in 'iu' and k.dtype.kind in 'iu' and n.size and k.size \
+            and min(n.min(), k.min()) >= 0 \
+            and max(n.max(), k.max()) < len(_log_comb_table):
+        return _log_comb_table[n, k][()]
+    return log_binom(n, k)
+
+
 def logQ(z, n):
     return (n-0.5)*np.log1p(n/z) + z*(np.log1p(n/z) - n/z)
 
 
 def loggamma_star(a):
-    if a == 0:
-        output = np.float('inf')
-    elif a > 1e9:
-        output = 0.0
-    else:
+    a = np.asarray(a, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
         output = (loggamma(a) + a - 0.5*np.log(2*np.pi) -
                   (a - 0.5)*np.log(a))
-    return output
+    output = np.where(a == 0, np.inf, output)
+    output = np.where(a > 1e9, 0.0, output)
+    return output[()]
 
 
 def loggamma_ratio(z, n):
@@ -26,7 +65,7 @@ def loggamma_ratio(z, n):
 
 
 def betabinom_log_pmf(k, n, a, b):
-    log_out = (log_binom(n, k) + loggamma_ratio(a, k) + loggamma_ratio(b, n-k) -
+    log_out = (log_comb(n, k) + loggamma_ratio(a, k) + loggamma_ratio(b, n-k) -
                loggamma_ratio(a+b, n))
     return log_out
 
@@ -36,11 +75,13 @@ def betabinom_pmf(k, n, a, b):
 
 
 def binom_pmf(k, n, p):
-    return comb(n, k) * (p ** k) * ((1 - p) ** (n - k))
+    return np.exp(log_comb(n, k)) * (p ** k) * ((1 - p) ** (n - k))
 
 
 def binom_log_pmf(k, n, p):
-    nck = -betaln(1 + n - k, 1 + k) - np.log(n + 1)
-    pk = k * np.log(p)
-    qnmk = (n - k) * np.log(1 - p)
+    # xlogy and xlog1py define 0 * log(0) as 0 so that p = 0 and p = 1
+    # are handled
+    nck = log_comb(n, k)
+    pk = xlogy(k, p)
+    qnmk = xlog1py(n - k, -p)
     return nck + pk + qnmk
@@ -1,6 +1,5 @@
 import numpy as np
 import pandas as pd
-from multiprocessing import Pool
 from sklearn.ensemble import RandomForestClassifier
 from bioexp.curation.model_fit import ModelFit, ens_sample
 from sklearn.linear_model import LogisticRegression
@@ -88,9 +87,8 @@ class BeliefModel(object):
             print(reader, r_df.shape)
             model = OrigBeliefStmt(weights=sample_weight)
             mf = ModelFit(model, correct_by_num_ev)
-            with Pool() as pool:
-                sampler = ens_sample(mf, self.nwalkers, self.burn_steps,
-                                     self.sample_steps, pool=pool)
+            sampler = ens_sample(mf, self.nwalkers, self.burn_steps,
+                                 self.sample_steps, vectorize=True)
             self.reader_results[reader] = (mf, sampler)
 
     def predict_proba(self, x_arr):
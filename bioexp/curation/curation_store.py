@@ -0,0 +1,250 @@
+"""An incremental SQLite store of curations.
+
+Curations are appended to the store as they arrive (e.g., from new dumps of
+the curation database, see add_curations) and can be queried by source,
+pa_hash or source_hash using the corresponding indexes. Queries return
+curations in the order in which they were added, i.e., in the order of the
+curation JSON dump, rather than ordered by id. Each source has a
+revision number which is incremented whenever curations with that source
+are added. Tables derived from the curations of a set of sources, such as
+the correct_by_num_ev tables of process_curations, can be cached in the
+store along with the revisions of these sources, and are invalidated only
+when curations for one of the sources change.
+
+Usage: python -m bioexp.curation.curation_store [<curation json> ...]
+"""
+import sys
+import json
+import fcntl
+import contextlib
+import pickle
+import sqlite3
+import logging
+from os import pardir
+from os.path import dirname, abspath, join, exists, getmtime
+
+
+logger = logging.getLogger('curation_store')
+here = dirname(abspath(__file__))
+curation_data = join(here, pardir, pardir, 'data', 'curation')
+curation_json = join(curation_data, 'indra_assembly_curations.json')
+curation_db = join(curation_data, 'indra_assembly_curations.db')
+
+# Fields of the curation dicts in the order of the curation table columns
+curation_fields = ['id', 'source', 'pa_hash', 'source_hash', 'tag',
+                   'curator', 'date', 'text', 'pa_json', 'ev_json']
+
+schema = """
+CREATE TABLE IF NOT EXISTS curation (
+    id INTEGER PRIMARY KEY,
+    source TEXT,
+    pa_hash INTEGER,
+    source_hash INTEGER,
+    tag TEXT,
+    curator TEXT,
+    date TEXT,
+    text TEXT,
+    pa_json TEXT,
+    ev_json TEXT,
+    seq INTEGER
+);
+CREATE INDEX IF NOT EXISTS curation_seq ON curation (seq);
+CREATE INDEX IF NOT EXISTS curation_source ON curation (source);
+CREATE INDEX IF NOT EXISTS curation_pa_hash ON curation (pa_hash);
+CREATE INDEX IF NOT EXISTS curation_source_hash ON curation (source_hash);
+CREATE TABLE IF NOT EXISTS source_revision (
+    source TEXT PRIMARY KEY,
+    revision INTEGER
+);
+CREATE TABLE IF NOT EXISTS derived_cache (
+    key TEXT PRIMARY KEY,
+    revisions TEXT,
+    value BLOB
+);
+CREATE TABLE IF NOT EXISTS json_sync (
+    path TEXT PRIMARY KEY,
+    mtime REAL
+);
+"""
+
+
+class CurationStore(object):
+    """An SQLite store of curations with cached derived tables.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database, which is created if it doesn't exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Wait for writes of other processes rather than failing
+        self.conn = sqlite3.connect(path, timeout=600)
+        self.conn.executescript(schema)
+
+    def add_curations(self, curations):
+        """Append curations that are not yet in the store.
+
+        Curations are identified by their id, so adding curations that
+        were added before has no effect.
+
+        Parameters
+        ----------
+        curations : list[dict]
+            Curation dicts as dumped from the curation database.
+
+        Returns
+        -------
+        int
+            The number of curations that were added.
+        """
+        num_added = 0
+        added = set()
+        query = 'INSERT OR IGNORE INTO curation (%s) VALUES (%s)' % \
+            (', '.join(curation_fields + ['seq']),
+             ', '.join('?' * (len(curation_fields) + 1)))
+        with self.conn:
+            # Curations are numbered in the order in which they are added,
+            # in a write transaction so that no other process can add
+            # curations with the same numbers
+            self.conn.execute('BEGIN IMMEDIATE')
+            seq = self.conn.execute('SELECT COALESCE(MAX(seq), 0) '
+                                    'FROM curation').fetchone()[0]
+            for cur in curations:
+                row = [cur.get(field) for field in curation_fields]
+                # The JSON of statements and evidences is stored as text
+                row[-2:] = [json.dumps(v) if v is not None else None
+                            for v in row[-2:]]
+                res = self.conn.execute(query, row + [seq + 1])
+                if res.rowcount:
+                    seq += 1
+                    num_added += 1
+                    added.add(cur['source'])
+            for source in added:
+                self.conn.execute(
+                    'INSERT OR IGNORE INTO source_revision VALUES (?, 0)',
+                    (source,))
+                self.conn.execute(
+                    'UPDATE source_revision SET revision = revision + 1 '
+                    'WHERE source = ?', (source,))
+        return num_added
+
+    def add_curations_json(self, path):
+        """Append the curations in a JSON dump if it changed since it was
+        last added, and return the number of curations that were added."""
+        mtime = getmtime(path)
+        res = self.conn.execute('SELECT mtime FROM json_sync WHERE path = ?',
+                                (abspath(path),)).fetchone()
+        if res is not None and res[0] == mtime:
+            return 0
+        with open(path, 'r') as fh:
+            curations = json.load(fh)
+        num_added = self.add_curations(curations)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO json_sync VALUES (?, ?)',
+                              (abspath(path), mtime))
+        logger.info('Added %d new curations from %s' % (num_added, path))
+        return num_added
+
+    def count(self):
+        """Return the number of curations in the store."""
+        return self.conn.execute('SELECT COUNT(*) FROM curation').fetchone()[0]
+
+    def get_curations(self, source=None, pa_hash=None, source_hash=None):
+        """Return the curations matching all of the given constraints.
+
+        Parameters
+        ----------
+        source : Optional[str]
+            The source tag of the curations.
+        pa_hash : Optional[int]
+            The hash of the curated statement.
+        source_hash : Optional[int]
+            The source hash of the curated evidence.
+
+        Returns
+        -------
+        list[dict]
+            Curation dicts in the order in which they were added.
+        """
+        constraints = [(field, value) for field, value in
+                       (('source', source), ('pa_hash', pa_hash),
+                        ('source_hash', source_hash)) if value is not None]
+        query = 'SELECT %s FROM curation' % ', '.join(curation_fields)
+        if constraints:
+            query += ' WHERE ' + ' AND '.join('%s = ?' % field for field, _
+                                              in constraints)
+        query += ' ORDER BY seq'
+        rows = self.conn.execute(query, [value for _, value in constraints])
+        return [_curation_from_row(row) for row in rows]
+
+    def get_revisions(self, sources):
+        """Return a dict of the current revisions of the given sources."""
+        revisions = {source: 0 for source in sources}
+        for source in sources:
+            res = self.conn.execute(
+                'SELECT revision FROM source_revision WHERE source = ?',
+                (source,)).fetchone()
+            if res is not None:
+                revisions[source] = res[0]
+        return revisions
+
+    def get_cached(self, key, sources):
+        """Return a cached value derived from the curations of the given
+        sources, or None if it isn't cached or the curations changed."""
+        res = self.conn.execute('SELECT revisions, value FROM derived_cache '
+                                'WHERE key = ?', (key,)).fetchone()
+        if res is None or json.loads(res[0]) != self.get_revisions(sources):
+            return None
+        return pickle.loads(res[1])
+
+    def set_cached(self, key, sources, value):
+        """Cache a value derived from the curations of the given sources."""
+        revisions = json.dumps(self.get_revisions(sources))
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO derived_cache VALUES (?, ?, ?)',
+                (key, revisions, pickle.dumps(value)))
+
+
+def _curation_from_row(row):
+    cur = dict(zip(curation_fields, row))
+    for field in ('pa_json', 'ev_json'):
+        if cur[field] is not None:
+            cur[field] = json.loads(cur[field])
+    return cur
+
+
+_store = None
+
+
+@contextlib.contextmanager
+def _sync_lock():
+    # An exclusive lock held while curation dumps are added to the default
+    # store, so that scripts run in parallel (e.g., by make -j) don't build
+    # or update it at the same time. The others wait and then find the
+    # store up to date.
+    with open(curation_db + '.lock', 'w') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        yield
+
+
+def get_curation_store():
+    """Return the default curation store, adding any new curations from the
+    curation JSON dump if it changed."""
+    global _store
+    if _store is None:
+        with _sync_lock():
+            _store = CurationStore(curation_db)
+            if exists(curation_json):
+                _store.add_curations_json(curation_json)
+    return _store
+
+
+if __name__ == '__main__':
+    with _sync_lock():
+        store = CurationStore(curation_db)
+        for path in (sys.argv[1:] or [curation_json]):
+            print('Added %d curations from %s' %
+                  (store.add_curations_json(path), path))
+    print('%d curations in %s' % (store.count(), curation_db))
@@ -1,9 +1,10 @@
 import sys
-from os.path import abspath, dirname, join
 import json
-import pickle
+import numpy as np
+from os.path import exists, join
 from collections import Counter
-from bioexp.util import prefixed_file
+from bioexp.util import prefixed_file, asmb_pkl, stmt_table_path, \
+    load_stmt_table, load_stmt_table_labels, load_pickle
 
 
 
@@ -16,9 +17,28 @@ def get_reader_ev_pmid_distro(reader, stmts):
             npmids = len({ev.pmid for ev in reader_ev})
             pmid_cnt.append(npmids)
             ev_cnt.append(len(reader_ev))
+    return _normalize_distros(ev_cnt, pmid_cnt)
 
-    pmid_distro = [Counter(pmid_cnt)[i] for i in range(1,11)]
-    ev_distro = [Counter(ev_cnt)[i] for i in range(1,11)]
+
+def get_reader_ev_pmid_distro_from_table(reader, table):
+    """Same as get_reader_ev_pmid_distro but using the source signature
+    columns (src_ev_count, src_pmid_count) of the columnar statement
+    table."""
+    labels = load_stmt_table_labels('ev_source_api')
+    if reader not in labels:
+        return _normalize_distros([], [])
+    col = labels.index(reader)
+    ev_counts = np.asarray(table['src_ev_count'][:, col])
+    pmid_counts = np.asarray(table['src_pmid_count'][:, col])
+    keep = (ev_counts >= 1) & (ev_counts <= 10)
+    return _normalize_distros(ev_counts[keep], pmid_counts[keep])
+
+
+def _normalize_distros(ev_cnt, pmid_cnt):
+    pmid_cnt = Counter(int(c) for c in pmid_cnt)
+    ev_cnt = Counter(int(c) for c in ev_cnt)
+    pmid_distro = [pmid_cnt[i] for i in range(1,11)]
+    ev_distro = [ev_cnt[i] for i in range(1,11)]
 
     dd = {(i+1): pmid_distro[i] for i in range(10)}
     s = sum(dd.values())
@@ -31,9 +51,16 @@ def get_reader_ev_pmid_distro(reader, stmts):
     return ev_distro_norm, pmid_distro_norm
 
 
-def dump_jsons(reader, stmts):
+def dump_jsons(reader, stmts=None, table=None):
+    """Dump the distributions for a reader, computed either from a list of
+    statements or from the columns of the statement table."""
     print(f'Dumping distributions for {reader}')
-    ev_distro_norm, pmid_distro_norm = get_reader_ev_pmid_distro(reader, stmts)
+    if table is not None:
+        ev_distro_norm, pmid_distro_norm = \
+            get_reader_ev_pmid_distro_from_table(reader, table)
+    else:
+        ev_distro_norm, pmid_distro_norm = \
+            get_reader_ev_pmid_distro(reader, stmts)
 
     ev_file = prefixed_file(f'{reader}_stmt_evidence_distribution', 'json')
     print(f'Dumping into {ev_file}')
@@ -47,13 +74,16 @@ def dump_jsons(reader, stmts):
 
 
 if __name__ == '__main__':
-    stmts_file = join(dirname(abspath(__file__)), '..', '..', 'data',
-                      'bioexp_asmb_preassembled.pkl')
-
-    with open(stmts_file, 'rb') as fh:
-        print(f'Loading {stmts_file}')
-        stmts = pickle.load(fh)
+    stmts, table = None, None
+    # Use the columnar table of the corpus if it was built, otherwise load
+    # the full pickle
+    if exists(join(stmt_table_path(), 'src_ev_count.npy')):
+        print(f'Loading columns from {stmt_table_path()}')
+        table = load_stmt_table(['src_ev_count', 'src_pmid_count'])
+    else:
+        print(f'Loading {asmb_pkl}')
+        stmts = load_pickle(asmb_pkl)
 
     readers = sys.argv[1:]
     for reader in readers:
-        dump_jsons(reader, stmts)
+        dump_jsons(reader, stmts=stmts, table=table)
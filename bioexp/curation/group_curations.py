@@ -1,11 +1,11 @@
 import sys
 import pickle
-from os.path import abspath, dirname, join
+from os.path import join
 from collections import Counter, defaultdict
-from indra.tools import assemble_corpus as ac
+from bioexp.util import load_stmts_by_hash
 from bioexp.curation.process_curations import \
             get_correctness_data, load_curated_pkl_files, get_full_curations, \
-            reader_input, get_raw_curations, CURATIONS
+            reader_input, get_raw_curations, load_assembled_stmts, get_curations
 
 
 def get_multi_reader_curations(reader_curations, reader_input,
@@ -215,7 +215,7 @@ def print_curation_stats(fname):
     with open(fname, 'rb') as fh:
         curs = pickle.load(fh)
     stmt_hashes = {c['stmt_hash'] for c in curs}
-    mention_hashes = {c['source_hash'] for c in CURATIONS
+    mention_hashes = {c['source_hash'] for c in get_curations()
                       if c['pa_hash'] in stmt_hashes}
     print('For %s, the number of unique Statements is %d and the number '
           'of corresponding mentions with curations is %d.' %
@@ -228,16 +228,21 @@ if __name__ == '__main__':
 
     output_dir = sys.argv[1]
 
-    # Load the pickle file with all assembled statements
-    asmb_pkl = join(dirname(abspath(__file__)), '..', '..', 'data',
-                    'bioexp_asmb_preassembled.pkl')
-    all_stmts = ac.load_statements(asmb_pkl)
-    all_stmts_by_hash = {stmt.get_hash(): stmt for stmt in all_stmts}
-
     all_sources = [source for rdr, rdr_dict in reader_input.items()
                    for source in rdr_dict['source_list']]
     all_sources.append('bioexp_paper_multi')
 
+    # Load the pickle file with all assembled statements, or if the
+    # statement index is available, only the statements that were curated
+    all_stmts = load_assembled_stmts()
+    if all_stmts is None:
+        curated_sources = set(all_sources) | {'bioexp_biogrid', 'bioexp_psp'}
+        all_stmts_by_hash = load_stmts_by_hash(
+            {cur['pa_hash'] for cur in get_curations()
+             if cur['source'] in curated_sources})
+    else:
+        all_stmts_by_hash = {stmt.get_hash(): stmt for stmt in all_stmts}
+
     multireader_curation_dataset = get_combined_curations(
           all_sources, all_stmts_by_hash,
           join(output_dir, 'multireader_curation_dataset.pkl'),
@@ -4,6 +4,7 @@ import logging
 import numpy as np
 from texttable import Texttable
 from matplotlib import pyplot as plt
+from bioexp.curation.belief_models import count_table
 
 
 logger = logging.getLogger('model_fit')
@@ -18,57 +19,136 @@ def posterior(position, mf):
         return pr + likelihood(position, mf)
 
 
+def posterior_vec(positions, mf):
+    """A log posterior function evaluated for all walkers at once.
+
+    Used with emcee's vectorize mode, positions is an array of shape
+    (nwalkers, ndim) and an array of nwalkers log posteriors is returned.
+    """
+    params = np.transpose(positions)
+    pr = prior(params, mf)
+    # Parameters outside of the prior's support can produce invalid values
+    # in the likelihood, these are discarded below
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lkl = likelihood(params, mf)
+    return np.where(pr == -np.inf, -np.inf, pr + lkl)
+
+
 def prior(position, mf):
     """A generic prior function."""
     return mf.model.log_prior(position, mf)
 
 
 def likelihood(position, mf):
-    return mf.model.log_likelihood(position, mf.data, None)
+    # Use the data compiled into a CountTable unless the data is flat
+    data = mf.raw_data if mf.counts is None else mf.counts
+    return mf.model.log_likelihood(position, data, None)
 
 
 class ModelFit(object):
+    """Fit of a belief model to curation data.
+
+    Parameters
+    ----------
+    model : bioexp.curation.belief_models.BeliefModel
+        The model to fit.
+    data : dict or bioexp.curation.belief_models.CountTable
+        Lists of the number of correct evidences of curated statements,
+        keyed by number of evidences, or the same data already compiled into
+        a CountTable. Only the CountTable is stored, so the size of the fit
+        scales with the number of distinct (num_ev, num_correct) cells
+        rather than with the number of curations.
+    flat_data : bool
+        If True, the data is stored and passed to the model as is.
+    """
     def __init__(self, model, data, flat_data=False):
         self.model = model
-        self.data = data
-        self.data_stmt = {}
-        # Convert at the evidence level to data at the stmt level and store
-        if not flat_data:
-            for num_ev in data.keys():
-                stmt_corrects = list(np.array(np.array(data[num_ev]) >= 1,
-                                              dtype=int))
-                self.data_stmt[num_ev] = stmt_corrects
+        self.counts = None
+        self.raw_data = None
+        if flat_data:
+            self.raw_data = data
+        else:
+            self.counts = count_table(data)
+
+    def __setstate__(self, state):
+        # Fits pickled before the data was stored as a CountTable
+        if 'data' in state:
+            data = state.pop('data')
+            state.pop('counts', None)
+            # Flat data was stored without statement-level data
+            if state.pop('data_stmt', None) or not data:
+                state.update({'counts': count_table(data), 'raw_data': None})
+            else:
+                state.update({'counts': None, 'raw_data': data})
+        self.__dict__.update(state)
+
+    @property
+    def data(self):
+        """Lists of numbers of correct evidences keyed by number of
+        evidences, expanded from the CountTable (or the flat data)."""
+        if self.counts is None:
+            return self.raw_data
+        data = {}
+        for num_ev, num_correct, count in zip(*self.counts[:3]):
+            data.setdefault(int(num_ev), []).extend([int(num_correct)] *
+                                                    int(count))
+        return data
+
+    @property
+    def data_stmt(self):
+        """Lists of statement correctness (0 or 1) keyed by number of
+        evidences."""
+        if self.counts is None:
+            return {}
+        return {num_ev: [1 if num_correct >= 1 else 0
+                         for num_correct in num_corrects]
+                for num_ev, num_corrects in self.data.items()}
+
+    def _check_counts(self, method):
+        # Flat data isn't organized by number of evidences, so it can't be
+        # compared with the statement or evidence level predictions
+        if self.counts is None:
+            raise ValueError('%s needs correct counts by number of '
+                             'evidences, which a ModelFit with flat_data '
+                             'doesn\'t have' % method)
+
+    def stmt_correctness(self):
+        """Return the numbers of evidences in the data with the
+        corresponding number of curated and correct statements."""
+        self._check_counts('stmt_correctness')
+        num_evs, ev_ix = np.unique(self.counts.num_ev, return_inverse=True)
+        totals = np.bincount(ev_ix, weights=self.counts.count)
+        corrects = np.bincount(ev_ix, weights=self.counts.count *
+                                              (self.counts.num_correct >= 1))
+        return num_evs, totals, corrects
 
     def stmt_err(self, sampler, weights=None):
+        self._check_counts('stmt_err')
         map_ix = np.argmax(sampler.flatlnprobability)
         map_p = sampler.flatchain[map_ix]
-        stmt_preds = self.model.stmt_predictions(map_p, self.data.keys())
-        ll = 0
-        for i, (num_ev, num_corrects) in enumerate(self.data.items()):
-            p = stmt_preds[i]
-            ll_n = 0
-            for num_correct in num_corrects:
-                if num_correct == 0:
-                    ll_n += np.log(1 - p)
-                else:
-                    ll_n += np.log(p)
-            if weights:
-                ll += weights[num_ev] * ll_n * len(self.data)
-            else:
-                ll += ll_n
-        return -ll
+        counts = self.counts
+        p = np.array(self.model.stmt_predictions(map_p, counts.num_ev))
+        ll_cells = np.log(np.where(counts.num_correct == 0, 1 - p, p)) * \
+            counts.count
+        if weights:
+            ll_cells *= np.array([weights[n] for n in counts.num_ev]) * \
+                counts.num_groups
+        return -np.sum(ll_cells)
 
     def plot_ev_fit(self, sampler, title):
+        self._check_counts('plot_ev_fit')
         fig = plt.figure()
         map_ix = np.argmax(sampler.flatlnprobability)
         map_p = sampler.flatchain[map_ix]
-        for n in range(1, max(self.data.keys())+1):
+        for n in range(1, int(max(self.counts.num_ev))+1):
             # First, plot the data
             plt.subplot(3, 4, n)
-            if n not in self.data:
+            if n not in self.counts.num_ev:
                 continue
             bin_counts = range(0, n+2)
-            plt.hist(self.data[n], bins=bin_counts, density=True)
+            cells = self.counts.num_ev == n
+            plt.hist(self.counts.num_correct[cells], bins=bin_counts,
+                     weights=self.counts.count[cells], density=True)
             plt.title(n)
             # Then plot the model predictions
             ev_lks = self.model.ev_predictions(map_p, n)
@@ -87,14 +167,13 @@ class ModelFit(object):
         return dict(zip(self.model.param_names, map_p))
 
     def plot_stmt_fit(self, sampler, label, color, ax=None):
+        self._check_counts('plot_stmt_fit')
         # Calculate the mean of correctness by number of evidence
-        num_evs = sorted(self.data.keys())
-        means = [np.mean(self.data_stmt[n]) for n in num_evs]
+        num_evs, totals, corrects = self.stmt_correctness()
+        means = corrects / totals
         # Stderr of proportion is sqrt(pq/n)
-        std = [2*np.sqrt((np.mean(self.data_stmt[n]) *
-                          (1 - np.mean(self.data_stmt[n]))) /
-                           len(self.data_stmt[n]))
-               for n in num_evs]
+        std = 2*np.sqrt(means * (1 - means) / totals)
+        num_evs = [int(n) for n in num_evs]
 
         # Plot the data
         if ax is None:
@@ -132,7 +211,7 @@ class ModelFit(object):
 
 
 def ens_sample(mf, nwalkers, burn_steps, sample_steps, threads=1,
-               pos=None, random_state=None, pool=None):
+               pos=None, random_state=None, pool=None, vectorize=False):
     """Samples from the posterior function using emcee.EnsembleSampler.
 
     The EnsembleSampler containing the chain is stored in gf.sampler.
@@ -161,6 +240,14 @@ def ens_sample(mf, nwalkers, burn_steps, sample_steps, threads=1,
     random_state : random state for Mersenne Twister PRNG
         The random state to use to initialize the sampler's pseudo-random
         number generator. Can be used to continue runs from previous ones.
+    pool : multiprocessing.Pool
+        A pool to evaluate the posterior of walkers in parallel. Ignored if
+        vectorize is True.
+    vectorize : bool
+        If True, the log posterior of all walkers is evaluated in a single
+        numpy call per step (emcee's vectorize mode) which requires a model
+        whose prior and likelihood accept arrays of parameter values, as
+        the models in bioexp.curation.belief_models do. Default: False
     """
     # Initialize the parameter array with initial values (in log10 units)
     # Number of parameters to estimate
@@ -177,9 +264,13 @@ def ens_sample(mf, nwalkers, burn_steps, sample_steps, threads=1,
         p0 = pos
 
     # Create the sampler object
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, posterior,
-                                         args=[mf],
-                                         threads=threads, pool=pool)
+    if vectorize:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, posterior_vec,
+                                        args=[mf], vectorize=True)
+    else:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, posterior,
+                                             args=[mf],
+                                             threads=threads, pool=pool)
     if random_state is not None:
         sampler.random_state = random_state
 
@@ -1,4 +1,3 @@
-import copy
 import sys
 import json
 import pickle
@@ -6,13 +5,14 @@ import logging
 import itertools
 from multiprocessing import Pool
 from os import pardir
-from os.path import dirname, abspath, join
+from os.path import dirname, abspath, join, exists, getmtime, getsize
 from texttable import Texttable
 import matplotlib.pyplot as plt
 from collections import defaultdict, Counter
-from indra.tools import assemble_corpus as ac
-from bioexp.util import prefixed_file, pkldump
+from bioexp.util import prefixed_file, pkldump, asmb_pkl, stmt_table_path, \
+    load_stmts_by_hash, get_evidence_index, load_pickle
 from bioexp.curation.belief_models import *
+from bioexp.curation.curation_store import get_curation_store
 from bioexp.curation.model_fit import ModelFit, ens_sample
 
 logger = logging.getLogger('process_curations')
@@ -24,13 +24,20 @@ def dist_path(reader, dist_type):
     return prefixed_file(f'{reader}_stmt_{dist_type}_distribution', 'json')
 
 
-def read_curations():
-    cur_fname = join(curation_data, 'indra_assembly_curations.json')
-    with open(cur_fname, 'r') as fh:
-        return json.load(fh)
+_curations = None
 
 
-CURATIONS = read_curations()
+def get_curations():
+    """Return the list of all curations.
+
+    The curations are loaded from the curation store (see
+    bioexp.curation.curation_store) the first time they are needed rather
+    than when this module is imported, and are cached afterwards.
+    """
+    global _curations
+    if _curations is None:
+        _curations = get_curation_store().get_curations()
+    return _curations
 
 
 reader_input = {
@@ -75,18 +82,27 @@ reader_input = {
 }
 
 
-def get_curations_for_reader(reader, all_stmts, aggregation, **kwargs):
+def get_curations_for_reader(reader, all_stmts, aggregation, use_cache=True,
+                             **kwargs):
     """Get correctness data for a given reader based on reader_input info.
 
     Parameters
     ----------
     reader : str
         Name of the reader, e.g. "reach".
-    all_stmts : list[indra.statements.Statement]
-        A list of all statements in the assembled corpus.
+    all_stmts : list[indra.statements.Statement] or None
+        A list of all statements in the assembled corpus. If None, the
+        curated statements are looked up in the statement table index.
     aggregation: str
         'evidence' to aggregate by distinct evidences, 'pmid' to
         aggregate by distinct PMIDs.
+    use_cache : bool
+        If True, the correctness data is cached in the curation store and
+        is only recomputed if curations for the reader's sources were added,
+        or its statement samples or the statement table changed since it
+        was cached. Only data computed from the statement table is cached,
+        since a list of statements passed as all_stmts can't be identified
+        without going through all of them. Default: True
 
     Returns
     -------
@@ -103,21 +119,49 @@ def get_curations_for_reader(reader, all_stmts, aggregation, **kwargs):
     else:
         raise ValueError("Reader %s not supported." % reader)
 
+    # Statements passed in directly may differ from those of the table
+    use_cache = use_cache and all_stmts is None
+    if use_cache:
+        store = get_curation_store()
+        cache_key = _correctness_cache_key(reader, pkl_list, aggregation,
+                                           kwargs)
+        ev_corrects = store.get_cached(cache_key, source_list)
+        if ev_corrects is not None:
+            logger.info('Using cached correctness data for %s' % reader)
+            return ev_corrects
+
     stmts = load_curated_pkl_files(pkl_list, all_stmts, reader)
     ev_corrects = get_correctness_data(source_list, stmts,
                                        aggregation=aggregation, **kwargs)
+    if use_cache:
+        store.set_cached(cache_key, source_list, ev_corrects)
     return ev_corrects
 
-# For debugging purposes, note module level global variables
-ALL_HASHES = set()
-ALL_MENTIONS = 0
+
+def _correctness_cache_key(reader, pkl_list, aggregation, kwargs):
+    # The statement samples the curations refer to and the statement table
+    # the sampled statements are loaded from are part of the key so that
+    # changing them (e.g., rebuilding the corpus) also invalidates the
+    # cached data
+    sample_mtimes = []
+    for pkl_file in pkl_list:
+        for path in (join(curation_data, pkl_file),
+                     join(curation_data,
+                          pkl_file.replace('.pkl', '_hashes.json'))):
+            if exists(path):
+                sample_mtimes.append(getmtime(path))
+    table_stats = []
+    for fname in ('stmt_hash.npy', 'stmt_records.bin'):
+        path = join(stmt_table_path(), fname)
+        if exists(path):
+            table_stats.append([getmtime(path), getsize(path)])
+    return json.dumps(['correct_by_num_ev', reader, aggregation,
+                       sorted(kwargs.items()), sample_mtimes, table_stats])
 
 
 def get_correctness_data(sources, stmts, aggregation='evidence',
                          allow_incomplete=False,
                          allow_incomplete_correct=False):
-    global ALL_HASHES
-    global ALL_MENTIONS
     stmts_dict = {stmt.get_hash(): stmt for stmt in stmts}
     stmt_counts = Counter(stmt.get_hash() for stmt in stmts)
     full_curations = get_full_curations(sources, stmts_dict,
@@ -125,19 +169,14 @@ def get_correctness_data(sources, stmts, aggregation='evidence',
                             allow_incomplete=allow_incomplete,
                             allow_incomplete_correct=allow_incomplete_correct)
     correct_by_num_ev = {}
-    ALL_HASHES |= set(full_curations)
     for pa_hash, corrects in full_curations.items():
         stmt = stmts_dict[pa_hash]
-        ALL_MENTIONS += len(stmt.evidence)
         num_correct = sum(corrects)
         num_correct_by_num_sampled = [num_correct] * stmt_counts[pa_hash]
         if len(stmt.evidence) not in correct_by_num_ev:
             correct_by_num_ev[len(stmt.evidence)] = num_correct_by_num_sampled
         else:
             correct_by_num_ev[len(stmt.evidence)] += num_correct_by_num_sampled
-    # Print ALL_HASHES and ALL_MENTIONS here to get the total numbers
-    logger.info("Total hashes up to this point: %d" % len(ALL_HASHES))
-    logger.info("Total mentions up to this point: %d" % ALL_MENTIONS)
     return correct_by_num_ev
 
 
@@ -165,8 +204,9 @@ def get_full_curations(sources, stmts_dict, aggregation='evidence',
         # curations. Note that we cannot go by number of curations
         # since two subtly different evidences can have the same hash, and
         # multiple curations sometimes exist for the same evidence.
-        ev_hashes = [e.get_source_hash() for e in cur_stmt.evidence]
-        ev_hash_count = Counter(ev_hashes)
+        ev_index = get_evidence_index(cur_stmt)
+        ev_hash_count = {source_hash: len(evs) for source_hash, evs
+                         in ev_index.items()}
         # We can now assign 0 or 1 to each evidence's curation(s), resolve
         # any inconsistencies at the level of a single evidence.
         pmid_curations = defaultdict(list)
@@ -192,12 +232,12 @@ def get_full_curations(sources, stmts_dict, aggregation='evidence',
 
         # The statement is complete, or if we don't care if it's not complete
         # let the statement through
-        if allow_incomplete or set(stmt_curs.keys()) == set(ev_hashes):
+        if allow_incomplete or set(stmt_curs.keys()) == set(ev_index):
             pass
         # The statement is incomplete but correct and we're allowing
         # incomplete correct stmts
         elif allow_incomplete_correct and any(evidence_corrects) and \
-                    set(stmt_curs.keys()) != set(ev_hashes):
+                    set(stmt_curs.keys()) != set(ev_index):
             print("Allowing incompletely curated correct stmt",
                   cur_stmt.uuid, cur_stmt)
         # Otherwise, the statement is incomplete AND either (so far) incorrect
@@ -251,8 +291,7 @@ def get_raw_curations(sources, stmts_dict):
     for source in sources:
         # Get curations from DB from given curation source
         # We populate the curations dict with entries from the DB
-        db_curations = [cur for cur in CURATIONS if
-                        cur['source'] == source]
+        db_curations = get_curation_store().get_curations(source=source)
         for cur in db_curations:
             if cur['pa_hash'] not in stmts_dict:
                 print('Curation pa_hash is missing from list of Statements '
@@ -266,9 +305,9 @@ def get_raw_curations(sources, stmts_dict):
 
 
 def _find_evidence_by_hash(stmt, source_hash):
-    for ev in stmt.evidence:
-        if ev.get_source_hash() == source_hash:
-            return ev
+    evs = get_evidence_index(stmt).get(source_hash)
+    if evs:
+        return evs[0]
 
 
 def load_curated_pkl_files(pkl_list, all_stmts, reader, use_jsons=True):
@@ -278,36 +317,95 @@ def load_curated_pkl_files(pkl_list, all_stmts, reader, use_jsons=True):
     instead we load the statement hashes from the JSONs that are in version
     control and filter the preassembled statements for the hashes to create
     the same set of statements as the ones in the pickle files, unless
-    use_jsons is set to False.
+    use_jsons is set to False. If all_stmts is None, the statements with
+    the given hashes are loaded directly from the index of the assembled
+    corpus (see bioexp.stmt_table) instead of being filtered from all
+    statements. When loading from the JSONs, the statements are returned
+    as ReaderStmtViews restricted to the evidences of the reader.
     """
-    all_stmts_by_hash = {stmt.get_hash(): stmt for stmt in all_stmts}
+    if all_stmts is not None:
+        all_stmts_by_hash = {stmt.get_hash(): stmt for stmt in all_stmts}
     logger.info('Loading curation statement pickles')
     stmts = []
     for pkl_file in pkl_list:
         pkl_path = join(curation_data, pkl_file)
         if not use_jsons:
             logger.info('Loading %s' % pkl_path)
-            with open(pkl_path, 'rb') as fh:
-                pkl_stmts = pickle.load(fh)
-                # Special handling for the pickle file for the TSV
-                if pkl_file == 'bioexp_reach_sample_tsv.pkl':
-                    for stmt in pkl_stmts:
-                        stmt.evidence = [e for e in stmt.evidence
-                                         if e.source_api == 'reach']
+            pkl_stmts = load_pickle(pkl_path)
+            # Special handling for the pickle file for the TSV
+            if pkl_file == 'bioexp_reach_sample_tsv.pkl':
+                for stmt in pkl_stmts:
+                    stmt.evidence = [e for e in stmt.evidence
+                                     if e.source_api == 'reach']
         else:
             json_path = pkl_path.replace('.pkl', '_hashes.json')
             logger.info('Loading %s' % json_path)
             with open(json_path, 'r') as fh:
                 hashes = json.load(fh)
-            pkl_stmts = copy.deepcopy([all_stmts_by_hash[hash]
-                                       for hash in hashes])
-            for stmt in pkl_stmts:
-                stmt.evidence = [e for e in stmt.evidence
-                                 if e.source_api == reader]
+            if all_stmts is None:
+                all_stmts_by_hash = load_stmts_by_hash(hashes)
+            pkl_stmts = [ReaderStmtView(all_stmts_by_hash[hash], reader)
+                         for hash in hashes]
         stmts.extend(pkl_stmts)
     return stmts
 
 
+class ReaderStmtView(object):
+    """A Statement restricted to the evidences from a given reader.
+
+    The view refers to the underlying Statement instead of copying it, so
+    creating it doesn't depend on the size of the Statement's agents or
+    supports graph. It exposes the parts of the Statement used by
+    get_correctness_data and get_full_curations.
+
+    Parameters
+    ----------
+    stmt : indra.statements.Statement
+        The Statement to restrict.
+    reader : str
+        The source_api of the evidences to keep.
+    """
+    __slots__ = ['stmt', 'evidence', '_hash', '__weakref__']
+
+    def __init__(self, stmt, reader):
+        self.stmt = stmt
+        self.evidence = [e for e in stmt.evidence if e.source_api == reader]
+        self._hash = stmt.get_hash()
+
+    def get_hash(self):
+        return self._hash
+
+    @property
+    def uuid(self):
+        return self.stmt.uuid
+
+    def agent_list(self, deep_sorted=False):
+        return self.stmt.agent_list(deep_sorted=deep_sorted)
+
+    def real_agent_list(self):
+        return self.stmt.real_agent_list()
+
+    def __str__(self):
+        return str(self.stmt)
+
+    def __repr__(self):
+        return repr(self.stmt)
+
+
+def load_assembled_stmts():
+    """Return all assembled statements, or None if the statement table index
+    was built, in which case curated statements are looked up by hash."""
+    table_dir = stmt_table_path()
+    # The files that load_stmts_by_hash needs, which are all there only if
+    # the table was built completely
+    table_files = ['stmt_records.bin', 'hash_sorted.npy', 'hash_order.npy',
+                   'stmt_offset.npy']
+    if all(exists(join(table_dir, fname)) for fname in table_files):
+        logger.info('Using statement index in %s' % table_dir)
+        return None
+    return load_pickle(asmb_pkl)
+
+
 def load_stmt_evidence_distribution(reader):
     """Return a dict of empirical evidence count distributions in the corpus."""
     ev_file = prefixed_file(f'{reader}_stmt_evidence_distribution', 'json')
@@ -317,67 +415,47 @@ def load_stmt_evidence_distribution(reader):
     return ev_probs
 
 
-# MAIN -----------------------------------------------------------------
+# MODEL FITTING ----------------------------------------------------------
 
+models = {
+    'orig_belief_ev': OrigBeliefEv,
+    'orig_belief_stmt': OrigBeliefStmt,
+    'binom_ev': BinomialEv,
+    'binom_stmt': BinomialStmt,
+    'betabinom_ev': BetaBinomialEv,
+    'betabinom_stmt': BetaBinomialStmt
+    }
 
-if __name__ == '__main__':
-    plt.ion()
-
-    reader = sys.argv[1]
-    output_dir = sys.argv[2]
-
-    # Load the pickle file with all assembled statements
-    asmb_pkl = join(dirname(abspath(__file__)), '..', '..', 'data',
-                    'bioexp_asmb_preassembled.pkl')
-    all_stmts = ac.load_statements(asmb_pkl)
-
-    ev_correct_by_num_ev = get_curations_for_reader(
-                                    reader, all_stmts, aggregation='evidence',
-                                    allow_incomplete=False)
-    #ev_correct_by_num_pmid = get_curations_for_reader(
-    #                                reader, all_stmts, aggregation='pmid',
-    #                                allow_incomplete=False)
-
-    # -- Everything below is for model fitting! --
-    # Load evidence frequency data
-    with open(reader_input[reader]['ev_dist_path'], 'rt') as f:
-        ev_dist = json.load(f)
-        # Convert string keys to integer keys
-        ev_dist = {int(k): v for k, v in ev_dist.items()}
 
-    # Load PMID frequency data
-    with open(reader_input[reader]['pmid_dist_path'], 'rt') as f:
-        pmid_dist = json.load(f)
+def load_dist(path):
+    """Load an evidence or PMID frequency distribution from a JSON file."""
+    with open(path, 'rt') as f:
+        dist = json.load(f)
         # Convert string keys to integer keys
-        pmid_dist = {int(k): v for k, v in pmid_dist.items()}
-
-    aggregations = {#'pmid': (ev_correct_by_num_pmid, pmid_dist),}
-                    'evidence': (ev_correct_by_num_ev, ev_dist)}
-    models = {
-        'orig_belief_ev': OrigBeliefEv,
-        'orig_belief_stmt': OrigBeliefStmt,
-        'binom_ev': BinomialEv,
-        'binom_stmt': BinomialStmt,
-        'betabinom_ev': BetaBinomialEv,
-        'betabinom_stmt': BetaBinomialStmt
-        }
-    results = []
-    for aggregation_type, (data, ev_dist_weights) in aggregations.items():
-        for model_name, model_class in models.items():
-            model_name = f'{model_name}_{aggregation_type}'
-            model = model_class(weights=ev_dist_weights)
-            print(f'Fitting {model_name}')
-            mf = ModelFit(model, data)
-            nwalkers, burn_steps, sample_steps = (100, 100, 100)
-            with Pool() as pool:
-                sampler = ens_sample(mf, nwalkers, burn_steps, sample_steps,
-                                     pool=pool)
-            filename = f'{reader}_{model_name}_sampler'
-            sampler.pool = None
-            pkldump((mf, sampler), filename)
-            results.append((model_name, mf, sampler))
-            mf.plot_ev_fit(sampler, model_name)
-            mf.plot_stmt_fit(sampler, model_name, 'red')
+        return {int(k): v for k, v in dist.items()}
+
+
+def fit_model(reader, model_name, aggregation_type, data, weights,
+              nwalkers=100, burn_steps=100, sample_steps=100):
+    """Fit one model to the curations of a reader and dump the sampler."""
+    model = models[model_name](weights=weights)
+    model_name = f'{model_name}_{aggregation_type}'
+    print(f'Fitting {model_name} for {reader}')
+    mf = ModelFit(model, data)
+    sampler = ens_sample(mf, nwalkers, burn_steps, sample_steps,
+                         vectorize=True)
+    filename = f'{reader}_{model_name}_sampler'
+    sampler.pool = None
+    pkldump((mf, sampler), filename)
+    return reader, model_name, mf, sampler
+
+
+def report_fits(reader, results, ev_dist, output_dir):
+    """Plot, tabulate and pickle the results of fitting models to the
+    curations of a reader."""
+    for model_name, mf, sampler in results:
+        mf.plot_ev_fit(sampler, model_name)
+        mf.plot_stmt_fit(sampler, model_name, 'red')
 
     stmt_lkls = []
     stmt_lkls_wt = []
@@ -397,6 +475,7 @@ if __name__ == '__main__':
     table_data = [('Model', '-log(Max Lkl)', '-log(Max Lkl) Wtd.')]
     table_data.extend(zip(labels, stmt_lkls, stmt_lkls_wt))
     table.add_rows(table_data)
+    logger.info('Model fits for %s' % reader)
     print(table.draw())
 
     # Pickle results
@@ -404,3 +483,75 @@ if __name__ == '__main__':
     with open(results_path, 'wb') as f:
         pickle.dump(results, f)
 
+
+def fit_readers(readers, output_dir, aggregation_types=('evidence',),
+                processes=None):
+    """Fit every model for every reader and aggregation concurrently.
+
+    The assembled statements are loaded once, after which the fits for all
+    (reader, model, aggregation) combinations are run in a single pool of
+    processes. Each sampler is pickled by the worker as soon as its fit
+    finishes, and the results for a reader are reported as soon as all its
+    fits are done.
+
+    Parameters
+    ----------
+    readers : list[str]
+        Names of the readers, e.g. ["reach", "sparser"].
+    output_dir : str
+        Folder in which the fig4_model_fit_results_<reader>.pkl files are
+        written.
+    aggregation_types : tuple[str]
+        'evidence' and/or 'pmid'. Default: ('evidence',)
+    processes : Optional[int]
+        Number of processes in the pool. Default: the number of CPUs.
+    """
+    # Load the pickle file with all assembled statements
+    all_stmts = load_assembled_stmts()
+    jobs = []
+    ev_dists = {}
+    for reader in readers:
+        ev_dists[reader] = load_dist(reader_input[reader]['ev_dist_path'])
+        for aggregation_type in aggregation_types:
+            if aggregation_type == 'pmid':
+                weights = load_dist(reader_input[reader]['pmid_dist_path'])
+            else:
+                weights = ev_dists[reader]
+            data = get_curations_for_reader(reader, all_stmts,
+                                            aggregation=aggregation_type,
+                                            allow_incomplete=False)
+            for model_name in models:
+                jobs.append((reader, model_name, aggregation_type, data,
+                             weights))
+    del all_stmts
+
+    # The order in which the results of each reader are reported
+    model_order = [f'{model_name}_{aggregation_type}'
+                   for aggregation_type in aggregation_types
+                   for model_name in models]
+    results = defaultdict(dict)
+    with Pool(processes) as pool:
+        for reader, model_name, mf, sampler in \
+                pool.imap_unordered(_fit_model_job, jobs):
+            results[reader][model_name] = (model_name, mf, sampler)
+            if len(results[reader]) == len(model_order):
+                report_fits(reader, [results[reader][model_name]
+                                     for model_name in model_order],
+                            ev_dists[reader], output_dir)
+
+
+def _fit_model_job(job):
+    return fit_model(*job)
+
+
+# MAIN -----------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    plt.ion()
+
+    # The readers can be given as a comma-separated list or as "all"
+    readers = sys.argv[1]
+    output_dir = sys.argv[2]
+    readers = list(reader_input) if readers == 'all' else readers.split(',')
+    fit_readers(readers, output_dir)
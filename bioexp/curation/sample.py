@@ -3,9 +3,8 @@ import numpy
 import pickle
 from copy import copy
 from collections import defaultdict, Counter
-from indra.tools import assemble_corpus as ac
 from indra.assemblers.tsv import TsvAssembler
-from bioexp.util import pkldump
+from bioexp.util import pkldump, load_pickle
 
 
 
@@ -82,7 +81,7 @@ if __name__ == '__main__':
     output_dir = sys.argv[5]
     sources = sys.argv[6:]
 
-    stmts = ac.load_statements(stmts_pkl)
+    stmts = load_pickle(stmts_pkl)
 
     # Set numpy random seed
     numpy.random.seed(1)
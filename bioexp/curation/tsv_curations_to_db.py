@@ -2,16 +2,15 @@
 (REACH curations, 2019-11-20) to the INDRA DB curations table."""
 import sys
 import csv
-from indra.tools import assemble_corpus as ac
 from indra_db.client.principal.curation import submit_curation
-from bioexp.util import pklload
+from bioexp.util import pklload, load_pickle
 
 if __name__ == '__main__':
     # Get a dict of all curations by UUID
     curation_file = sys.argv[1]
     stmt_file = sys.argv[2]
 
-    stmts = ac.load_statements(stmt_file)
+    stmts = load_pickle(stmt_file)
     stmt_dict = {s.uuid: s for s in stmts}
 
     # Some default args for the curations
@@ -56,17 +55,16 @@ if __name__ == '__main__':
             #if pa_hash == 23109912213960991:
             #    import ipdb; ipdb.set_trace()
 
-            stmt_ev = None
-            for ev in stmt.evidence:
-                if ev.text == ev_text and ev.source_api == 'reach':
-                    stmt_ev = ev
-            if stmt_ev is None:
+            # The last evidence with the curated text is the one curated
+            stmt_evs = [ev for ev in stmt.evidence
+                        if ev.text == ev_text and ev.source_api == 'reach']
+            if not stmt_evs:
                 print("Could not find evidence for statement %s, text %s")
                 continue
             # Something weird here--different texts are producing same
             # source hash TODO TODO TODO
             else:
-                source_hash = stmt_ev.get_source_hash()
+                source_hash = stmt_evs[-1].get_source_hash()
 
             print(pa_hash, tag, curator, ip, comment, source_hash,
                   'bioexp_paper_tsv')
@@ -1,9 +1,9 @@
-import pickle
 from collections import Counter
 from os.path import dirname, join
 from matplotlib import pyplot as plt
 from indra.preassembler import render_stmt_graph
-from bioexp.util import set_fig_params, fontsize, format_axis, red, based
+from bioexp.util import set_fig_params, fontsize, format_axis, red, based, \
+    load_pickle
 
 def plot_frequencies(counts, x_label, y_label, fig_filename, plot_type='dot',
                      log_x=False, log_y=False):
@@ -57,8 +57,7 @@ if __name__ == '__main__':
 
     # Load the pickle
     print("Loading statements from %s" % stmts_file)
-    with open(stmts_file, 'rb') as f:
-        stmts = pickle.load(f)
+    stmts = load_pickle(stmts_file)
     print("%d stmts" % len(stmts))
 
     set_fig_params()
@@ -1,12 +1,11 @@
 import sys
 import csv
-from os.path import join, dirname, abspath
+from os.path import join
 import numpy as np
 from matplotlib import pyplot as plt
-from indra.tools import assemble_corpus as ac
 from bioexp.curation.process_curations import get_curations_for_reader, \
                                     reader_input, load_curated_pkl_files, \
-                                    get_correctness_data
+                                    get_correctness_data, load_assembled_stmts
 from bioexp.util import set_fig_params, format_axis, fontsize, reader_name_map
 
 
@@ -110,9 +109,7 @@ def dataset_table(
 
 if __name__ == '__main__':
     # Load the pickle file with all assembled statements
-    asmb_pkl = join(dirname(abspath(__file__)), '..', '..', '..', 'data',
-                    'bioexp_asmb_preassembled.pkl')
-    all_stmts = ac.load_statements(asmb_pkl)
+    all_stmts = load_assembled_stmts()
     # Get output directory
     output_dir = sys.argv[1]
     plot_correctness_curve('reach', all_stmts, show_ylabel=True, allow_incomplete=True)
@@ -11,11 +11,12 @@ from indra.databases import biogrid_client as bg
 from indra.databases import hgnc_client, uniprot_client
 from indra.util import write_unicode_csv
 from indra.tools import assemble_corpus as ac
+from bioexp.pickle_io import load_pickle
 
 logger = logging.getLogger('complexes')
 
 def preprocess_stmts(filename, sample_size=None):
-    all_stmts = ac.load_statements(filename)
+    all_stmts = load_pickle(filename)
 
     complexes = ac.filter_by_type(all_stmts, Complex)
     # Require HGNC grounding
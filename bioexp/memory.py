@@ -0,0 +1,53 @@
+"""Information about the memory available on this machine."""
+import os
+
+
+def get_available_memory():
+    """Return the memory available for new processes in bytes.
+
+    This is MemAvailable from /proc/meminfo, which, unlike the free memory,
+    includes the page cache and other memory that can be reclaimed. If it
+    can't be read (e.g., not on Linux), the free memory is returned, or None
+    if that isn't known either.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    # The value is given in kB
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_num_processes(worker_memory, max_processes=None):
+    """Return the number of worker processes to use on this machine.
+
+    Parameters
+    ----------
+    worker_memory : int
+        The memory taken up by each worker process in bytes.
+    max_processes : Optional[int]
+        The maximum number of processes. Default: the number of cores
+        available to this process
+
+    Returns
+    -------
+    int
+        The maximum number of processes, limited so that each of them has
+        worker_memory of the available memory, but at least 1. If the
+        available memory isn't known, the number isn't limited.
+    """
+    if max_processes is None:
+        try:
+            max_processes = len(os.sched_getaffinity(0))
+        except AttributeError:
+            max_processes = os.cpu_count() or 1
+    avail_memory = get_available_memory()
+    if avail_memory is None:
+        return max_processes
+    return max(1, min(max_processes, avail_memory // max(worker_memory, 1)))
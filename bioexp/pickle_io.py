@@ -0,0 +1,203 @@
+"""Writing and reading large, optionally compressed pickle files.
+
+Pickles are written with protocol 5. Uncompressed pickles are plain pickle
+files, which can be loaded with pickle.load (e.g., in notebooks). Compressed
+pickles are written with buffers that support out-of-band pickling (e.g.,
+the data of numpy arrays) separately instead of being copied into the pickle
+stream. Such a file consists of a header followed by a section with the
+pickle stream and a section with the out-of-band buffers, each of which is
+compressed with zstd or lz4. The header holds
+
+    magic (8 bytes) | compression (8 bytes, NUL-padded ASCII) |
+    number of buffers (8 bytes) | offset of the buffer section (8 bytes)
+
+and the buffer section consists of the size (8 bytes) and the bytes of each
+buffer. zstd compression requires the compression.zstd module of Python
+3.14 or its backport (backports.zstd), and lz4 compression requires the lz4
+package.
+
+Lists that are dumped in chunks by dump_pickle_chunks are written into a
+similar file, with a different magic, the number of chunks and the total
+number of elements in the header, and a single section with one pickle per
+chunk, which is compressed unless the compression is 'none'. Since the
+chunks can't be streamed into a single pickle, such files are never plain
+pickle files and have to be loaded with load_pickle.
+
+load_pickle detects the format of a file, so it also reads plain pickle
+files (such as those dumped by ac.dump_statements) and plain pickle files
+compressed with the zstd or lz4 command line tools.
+"""
+import os
+import struct
+import pickle
+import contextlib
+
+
+compressions = ('none', 'zstd', 'lz4')
+
+magic = b'BXPICKLE'
+chunks_magic = b'BXPCHUNK'
+header = struct.Struct('<8s8sQQ')
+size_struct = struct.Struct('<Q')
+
+# The magic numbers at the start of zstd and lz4 frames
+frame_magics = {b'\x28\xb5\x2f\xfd': 'zstd',
+                b'\x04\x22\x4d\x18': 'lz4'}
+
+
+def _open_section(fh, compression, mode):
+    """Return a file object for a (compressed) section of an open file,
+    which doesn't close the file when closed."""
+    if compression == 'zstd':
+        try:
+            from compression import zstd
+        except ImportError:
+            from backports import zstd
+        return zstd.ZstdFile(fh, mode)
+    elif compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(fh, mode)
+    elif compression == 'none':
+        return contextlib.nullcontext(fh)
+    raise ValueError('Unknown compression %s, expected one of %s' %
+                     (compression, ', '.join(compressions)))
+
+
+def _check_compression(compression):
+    compression = compression or 'none'
+    if compression not in compressions:
+        raise ValueError('Unknown compression %s, expected one of %s' %
+                         (compression, ', '.join(compressions)))
+    return compression
+
+
+def dump_pickle(content, fname, compression=None):
+    """Dump content into a pickle file.
+
+    The file is written under a temporary name first and then renamed, so
+    an interrupted dump doesn't leave a truncated file behind.
+
+    Parameters
+    ----------
+    content : object
+        The object to pickle.
+    fname : str
+        The path to the pickle file.
+    compression : Optional[str]
+        One of 'zstd', 'lz4' or 'none'. If None or 'none', a plain pickle
+        file is written.
+    """
+    compression = _check_compression(compression)
+    tmp_fname = fname + '.tmp'
+    if compression == 'none':
+        with open(tmp_fname, 'wb') as fh:
+            pickle.dump(content, fh, protocol=5)
+        os.replace(tmp_fname, fname)
+        return
+    buffers = []
+    with open(tmp_fname, 'wb') as fh:
+        fh.write(header.pack(magic, compression.encode('ascii'), 0, 0))
+        with _open_section(fh, compression, 'wb') as section:
+            pickle.dump(content, section, protocol=5,
+                        buffer_callback=buffers.append)
+        buffers_offset = fh.tell()
+        with _open_section(fh, compression, 'wb') as section:
+            for buf in buffers:
+                data = buf.raw()
+                section.write(size_struct.pack(data.nbytes))
+                section.write(data)
+        # Now that the buffers and the offset of their section are known,
+        # they can be filled in
+        fh.seek(0)
+        fh.write(header.pack(magic, compression.encode('ascii'),
+                             len(buffers), buffers_offset))
+    os.replace(tmp_fname, fname)
+
+
+def dump_pickle_chunks(chunks, fname, compression=None):
+    """Dump lists into a single pickle file, which load_pickle loads as the
+    concatenation of the lists.
+
+    Each list is pickled as soon as it is generated, so only one of them
+    has to be held in memory at a time. The file is written in the chunked
+    format even if it isn't compressed, so it can only be loaded with
+    load_pickle, not with pickle.load.
+
+    Parameters
+    ----------
+    chunks : iterable[list]
+        The lists to dump.
+    fname : str
+        The path to the pickle file.
+    compression : Optional[str]
+        One of 'zstd', 'lz4' or 'none'. Default: None (no compression)
+
+    Returns
+    -------
+    int
+        The total number of elements in the lists.
+    """
+    compression = _check_compression(compression)
+    num_chunks = 0
+    num_elements = 0
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as fh:
+        fh.write(header.pack(chunks_magic, compression.encode('ascii'), 0, 0))
+        with _open_section(fh, compression, 'wb') as section:
+            for chunk in chunks:
+                pickle.dump(chunk, section, protocol=5)
+                num_chunks += 1
+                num_elements += len(chunk)
+        fh.seek(0)
+        fh.write(header.pack(chunks_magic, compression.encode('ascii'),
+                             num_chunks, num_elements))
+    os.replace(tmp_fname, fname)
+    return num_elements
+
+
+def _read_buffer(section, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while view:
+        num_read = section.readinto(view)
+        if not num_read:
+            raise EOFError('Pickle file ended in the middle of a buffer')
+        view = view[num_read:]
+    return buf
+
+
+def load_pickle(fname):
+    """Load a pickle file written by dump_pickle or dump_pickle_chunks, or
+    a plain pickle file, which may be compressed with zstd or lz4."""
+    with open(fname, 'rb') as fh:
+        start = fh.read(header.size)
+        fh.seek(0)
+        if start[:4] in frame_magics:
+            with _open_section(fh, frame_magics[start[:4]], 'rb') as section:
+                return pickle.load(section)
+        elif start.startswith(chunks_magic):
+            _, compression, num_chunks, _ = header.unpack(start)
+            compression = compression.rstrip(b'\0').decode('ascii')
+            content = []
+            fh.seek(header.size)
+            with _open_section(fh, compression, 'rb') as section:
+                for _ in range(num_chunks):
+                    content += pickle.load(section)
+            return content
+        elif not start.startswith(magic):
+            return pickle.load(fh)
+        _, compression, num_buffers, buffers_offset = header.unpack(start)
+        compression = compression.rstrip(b'\0').decode('ascii')
+        # The buffers have to be read before the pickle stream that refers
+        # to them
+        buffers = []
+        if num_buffers:
+            fh.seek(buffers_offset)
+            with _open_section(fh, compression, 'rb') as section:
+                for _ in range(num_buffers):
+                    size = size_struct.unpack(
+                        _read_buffer(section, size_struct.size))
+                    buffers.append(_read_buffer(section, size[0]))
+        fh.seek(header.size)
+        with _open_section(fh, compression, 'rb') as section:
+            return pickle.load(section, buffers=buffers)
@@ -0,0 +1,201 @@
+"""Build a columnar table from a pickle of INDRA Statements.
+
+Most analyses only need a few fields of each Statement and its evidences,
+however, loading them from a pickle requires unpickling the whole corpus.
+This script extracts these fields into one numpy file per column which can
+then be memory-mapped selectively using bioexp.util.load_stmt_table.
+
+Statement columns (one row per Statement, in pickle order):
+    stmt_hash : int64, the (shallow) hash of the Statement
+    stmt_type : int16, code of the Statement type
+    belief : float64, the belief of the Statement
+    ev_offset : int64, the Statement's evidences are rows
+        ev_offset[i]:ev_offset[i+1] of the evidence table (this column has
+        one more row than the number of Statements)
+
+Evidence columns (one row per Evidence):
+    ev_stmt_ix : int64, row of the Statement the evidence belongs to
+    ev_source_api : int16, code of the source API
+    ev_pmid : bytes, the PMID of the evidence (none_value if it is None)
+    ev_source_hash : int64, the source hash of the evidence
+
+Agent columns (one row per non-None Agent in agent_list order):
+    ag_stmt_ix : int64, row of the Statement the agent belongs to
+    ag_name : bytes, the name of the agent
+    ag_ns, ag_id : bytes, the namespace and ID of the agent's grounding
+        (none_value if the agent isn't grounded)
+
+The codes of categorical columns index into the label lists stored in
+labels.json. In bytes columns, None is stored as none_value (b'\\xff',
+which can't occur in UTF-8 text), so that it is distinct from an empty
+string.
+
+Source signature columns (one row per Statement, one column per source API
+in the order of the ev_source_api labels):
+    src_ev_count : int32, the number of evidences of the Statement from
+        each source
+    src_pmid_count : int32, the number of distinct PMIDs of these evidences
+        (evidences without a PMID count as one PMID)
+
+These are derived from the evidence columns, so that reports of per-source
+evidence and PMID counts don't have to iterate over the evidences. They can
+be added to a table built without them with the signatures command.
+
+In addition, each Statement is pickled individually into stmt_records.bin
+so that a few Statements can be loaded without unpickling the corpus (see
+bioexp.util.load_stmts_by_hash). The supports/supported_by lists of these
+Statements are left empty since pickling them would pull in the connected
+refinement graph. The index columns are:
+    stmt_offset : int64, Statement i is pickled at bytes
+        stmt_offset[i]:stmt_offset[i+1] of stmt_records.bin
+    hash_sorted : int64, the stmt_hash column in sorted order
+    hash_order : int64, the rows of the Statements in hash_sorted order
+
+Usage: python -m bioexp.stmt_table [signatures] [<statement pickle>]
+"""
+import os
+import sys
+import json
+import copy
+import pickle
+import numpy as np
+from os.path import join
+from bioexp.util import asmb_pkl, stmt_table_path, load_pickle, \
+    load_stmt_table, load_stmt_table_labels
+
+
+# The value of None in bytes columns. An empty or NUL byte string can't be
+# used since numpy strips trailing NUL bytes.
+none_value = b'\xff'
+
+
+def _encode(value):
+    return none_value if value is None else str(value).encode('utf-8')
+
+
+def _codes(values):
+    labels = sorted(set(values), key=str)
+    label_ix = {label: ix for ix, label in enumerate(labels)}
+    return np.array([label_ix[v] for v in values], dtype=np.int16), labels
+
+
+def _dump_record(stmt, fh):
+    # Detach the Statement from the refinement graph before pickling it
+    stmt = copy.copy(stmt)
+    stmt.supports = []
+    stmt.supported_by = []
+    pickle.dump(stmt, fh)
+    return fh.tell()
+
+
+def dump_stmt_table(stmts, table_dir):
+    """Write the columns of a columnar table for a list of Statements."""
+    cols = {'stmt_hash': [], 'stmt_type': [], 'belief': [], 'ev_offset': [0],
+            'ev_stmt_ix': [], 'ev_source_api': [], 'ev_pmid': [],
+            'ev_source_hash': [], 'ag_stmt_ix': [], 'ag_name': [],
+            'ag_ns': [], 'ag_id': [], 'stmt_offset': [0]}
+    os.makedirs(table_dir, exist_ok=True)
+    with open(join(table_dir, 'stmt_records.bin'), 'wb') as records_fh:
+        for stmt_ix, stmt in enumerate(stmts):
+            cols['stmt_offset'].append(_dump_record(stmt, records_fh))
+            cols['stmt_hash'].append(stmt.get_hash())
+            cols['stmt_type'].append(stmt.__class__.__name__)
+            cols['belief'].append(stmt.belief)
+            cols['ev_offset'].append(cols['ev_offset'][-1] +
+                                     len(stmt.evidence))
+            for ev in stmt.evidence:
+                cols['ev_stmt_ix'].append(stmt_ix)
+                cols['ev_source_api'].append(ev.source_api)
+                cols['ev_pmid'].append(_encode(ev.pmid))
+                cols['ev_source_hash'].append(ev.get_source_hash())
+            for ag in stmt.agent_list():
+                if ag is None:
+                    continue
+                ns, db_id = ag.get_grounding()
+                cols['ag_stmt_ix'].append(stmt_ix)
+                cols['ag_name'].append(_encode(ag.name))
+                cols['ag_ns'].append(_encode(ns))
+                cols['ag_id'].append(_encode(db_id))
+
+    labels = {}
+    arrays = {}
+    for col in ('stmt_type', 'ev_source_api'):
+        arrays[col], labels[col] = _codes(cols.pop(col))
+    for col in ('stmt_hash', 'ev_offset', 'ev_stmt_ix', 'ev_source_hash',
+                'ag_stmt_ix', 'stmt_offset'):
+        arrays[col] = np.array(cols.pop(col), dtype=np.int64)
+    arrays['hash_order'] = np.argsort(arrays['stmt_hash'], kind='stable')
+    arrays['hash_sorted'] = arrays['stmt_hash'][arrays['hash_order']]
+    arrays['belief'] = np.array(cols.pop('belief'), dtype=np.float64)
+    for col in ('ev_pmid', 'ag_name', 'ag_ns', 'ag_id'):
+        arrays[col] = np.array(cols.pop(col), dtype=np.bytes_)
+
+    for col, arr in arrays.items():
+        np.save(join(table_dir, '%s.npy' % col), arr)
+    with open(join(table_dir, 'labels.json'), 'w') as fh:
+        json.dump(labels, fh, indent=1)
+    dump_source_signatures(table_dir)
+
+
+def get_source_signatures(ev_stmt_ix, ev_source_api, ev_pmid, num_stmts,
+                          num_sources):
+    """Return the per-source evidence and PMID counts of Statements.
+
+    Parameters
+    ----------
+    ev_stmt_ix, ev_source_api, ev_pmid : numpy.ndarray
+        The evidence columns of a statement table.
+    num_stmts : int
+        The number of Statements in the table.
+    num_sources : int
+        The number of source API labels.
+
+    Returns
+    -------
+    ev_counts, pmid_counts : numpy.ndarray
+        Arrays of shape (num_stmts, num_sources) with the number of
+        evidences and distinct PMIDs of each Statement from each source.
+    """
+    # Each (Statement, source) pair is a cell of the flattened arrays
+    cells = np.asarray(ev_stmt_ix) * num_sources + np.asarray(ev_source_api)
+    ev_counts = np.bincount(cells, minlength=num_stmts * num_sources)
+    # Count the unique (cell, PMID) pairs for each cell
+    pmids, pmid_codes = np.unique(ev_pmid, return_inverse=True)
+    num_pmids = max(len(pmids), 1)
+    pairs = np.unique(cells * num_pmids + pmid_codes.ravel())
+    pmid_counts = np.bincount(pairs // num_pmids,
+                              minlength=num_stmts * num_sources)
+    shape = (num_stmts, num_sources)
+    return (ev_counts.astype(np.int32).reshape(shape),
+            pmid_counts.astype(np.int32).reshape(shape))
+
+
+def dump_source_signatures(table_dir):
+    """Write the source signature columns of a table, computed from its
+    evidence columns."""
+    table = load_stmt_table(['ev_offset', 'ev_stmt_ix', 'ev_source_api',
+                             'ev_pmid'], table_dir)
+    sources = load_stmt_table_labels('ev_source_api', table_dir)
+    ev_counts, pmid_counts = get_source_signatures(
+        table['ev_stmt_ix'], table['ev_source_api'], table['ev_pmid'],
+        len(table['ev_offset']) - 1, len(sources))
+    np.save(join(table_dir, 'src_ev_count.npy'), ev_counts)
+    np.save(join(table_dir, 'src_pmid_count.npy'), pmid_counts)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    # Only add the source signature columns to an existing table
+    signatures_only = bool(args) and args[0] == 'signatures'
+    if signatures_only:
+        args = args[1:]
+    pkl_path = args[0] if args else asmb_pkl
+    table_dir = stmt_table_path(pkl_path)
+    if signatures_only:
+        print('Writing source signatures into %s' % table_dir)
+        dump_source_signatures(table_dir)
+    else:
+        stmts = load_pickle(pkl_path)
+        print('Writing table for %d statements into %s' % (len(stmts),
+                                                            table_dir))
+        dump_stmt_table(stmts, table_dir)
@@ -0,0 +1,98 @@
+import numpy as np
+from bioexp.curation.belief_models import BinomialEv, BinomialStmt, \
+    BetaBinomialEv, BetaBinomialStmt, OrigBeliefEv, OrigBeliefStmt, \
+    count_table
+from bioexp.curation.binom_funcs import binom_pmf, binom_log_pmf, \
+    betabinom_pmf, betabinom_log_pmf
+from bioexp.curation.model_fit import ModelFit, posterior, posterior_vec
+
+
+# Number of correct evidences of curated statements by number of evidences
+correct_by_num_ev = {1: [0, 1, 1, 1, 0, 1],
+                     2: [2, 1, 0, 2, 2],
+                     3: [3, 0, 2, 3],
+                     5: [5, 4, 0],
+                     10: [10, 7]}
+
+weights = {1: 0.4, 2: 0.25, 3: 0.15, 5: 0.12, 10: 0.08}
+
+params_by_model = {
+    BinomialEv: [(0.3,), (0.75,), (0.99,)],
+    BinomialStmt: [(0.3,), (0.75,), (0.99,)],
+    BetaBinomialEv: [(0.5, 0.5), (2.0, 0.7), (8.0, 3.0)],
+    BetaBinomialStmt: [(0.5, 0.5), (2.0, 0.7), (8.0, 3.0)],
+    OrigBeliefEv: [(0.2, 0.1), (0.5, 0.3), (0.9, 0.05)],
+    OrigBeliefStmt: [(0.2, 0.1), (0.5, 0.3), (0.9, 0.05)],
+}
+
+
+def _cell_log_likelihood(model, params, num_ev, num_correct):
+    # The log likelihood of a single curated statement, evaluated with
+    # scalar arguments as in the loops the models used before
+    if isinstance(model, BinomialEv):
+        return binom_log_pmf(num_correct, num_ev, params[0])
+    elif isinstance(model, BinomialStmt):
+        prob_zero = binom_pmf(0, num_ev, params[0])
+    elif isinstance(model, BetaBinomialEv):
+        return betabinom_log_pmf(num_correct, num_ev, *params)
+    elif isinstance(model, BetaBinomialStmt):
+        prob_zero = betabinom_pmf(0, num_ev, *params)
+    elif isinstance(model, OrigBeliefEv):
+        pr, ps = params
+        if num_correct == 0:
+            return np.log(ps + (1-ps) * binom_pmf(0, num_ev, 1-pr))
+        return np.log((1-ps) * binom_pmf(num_correct, num_ev, 1-pr))
+    elif isinstance(model, OrigBeliefStmt):
+        prob_zero = 1 - model.belief(num_ev, *params)
+    return np.log(prob_zero if num_correct == 0 else 1 - prob_zero)
+
+
+def _loop_log_likelihood(model, params, data):
+    ll = 0
+    for num_ev, num_corrects in data.items():
+        ll_n = 0
+        for num_correct in num_corrects:
+            ll_n += _cell_log_likelihood(model, params, num_ev, num_correct)
+        if model.weights:
+            ll += model.weights[num_ev] * ll_n * len(data)
+        else:
+            ll += ll_n
+    return ll
+
+
+def test_log_likelihood_matches_loop():
+    counts = count_table(correct_by_num_ev)
+    for model_class, param_sets in params_by_model.items():
+        for model_weights in (None, weights):
+            model = model_class(model_weights)
+            for params in param_sets:
+                expected = _loop_log_likelihood(model, params,
+                                                correct_by_num_ev)
+                for data in (correct_by_num_ev, counts):
+                    np.testing.assert_allclose(
+                        model.log_likelihood(params, data, None), expected,
+                        rtol=1e-12, err_msg=model_class.__name__)
+
+
+def test_walker_log_likelihood_matches_loop():
+    # All walkers evaluated at once, as in emcee's vectorize mode
+    counts = count_table(correct_by_num_ev)
+    for model_class, param_sets in params_by_model.items():
+        for model_weights in (None, weights):
+            model = model_class(model_weights)
+            walker_params = np.transpose(param_sets)
+            expected = [_loop_log_likelihood(model, params, correct_by_num_ev)
+                        for params in param_sets]
+            np.testing.assert_allclose(
+                model.log_likelihood(walker_params, counts, None), expected,
+                rtol=1e-12, err_msg=model_class.__name__)
+
+
+def test_posterior_vec_matches_posterior():
+    for model_class, param_sets in params_by_model.items():
+        mf = ModelFit(model_class(weights), correct_by_num_ev)
+        # Include a position outside of the prior's support
+        positions = np.array(param_sets + [(-0.5,) * len(param_sets[0])])
+        expected = [posterior(position, mf) for position in positions]
+        np.testing.assert_allclose(posterior_vec(positions, mf), expected,
+                                   rtol=1e-12, err_msg=model_class.__name__)
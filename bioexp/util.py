@@ -2,8 +2,11 @@ import os
 import json
 import time
 import pickle
+import weakref
 import matplotlib
+import numpy as np
 from os.path import dirname, abspath, join
+from bioexp.pickle_io import dump_pickle, load_pickle
 
 
 # CREATE A JSON FILE WITH THIS INFORMATION, E.G., a file consisting of:
@@ -16,6 +19,13 @@ basen = config['basename']
 # This is the base folder to read/write (potentially large) files from/to
 # MODIFY ACCORDING TO YOUR OWN SETUP
 based = config['basedir']
+# The compression of the pickle files written by pkldump, which can be set
+# to 'zstd' or 'lz4' by an optional "pkl_compression" entry
+pkl_compression = config.get('pkl_compression')
+
+# The data folder at the root of the repository and the assembled corpus in it
+data_dir = join(dirname(abspath(__file__)), '..', 'data')
+asmb_pkl = join(data_dir, 'bioexp_asmb_preassembled.pkl')
 
 
 reader_name_map = {
@@ -49,11 +59,15 @@ def prefixed_file(suffix, extension):
     return os.path.join(based, basen + '_' + suffix + '.' + extension)
 
 
-def pkldump(content, suffix):
-    """Dump content into a pickle file based on a name suffix"""
+def pkldump(content, suffix, compression=None):
+    """Dump content into a pickle file based on a name suffix
+
+    The file is compressed as given by compression ('zstd', 'lz4' or
+    'none'), or by pkl_compression if compression is None (see
+    bioexp.pickle_io.dump_pickle).
+    """
     fname = prefixed_pkl(suffix)
-    with open(fname, 'wb') as fh:
-        pickle.dump(content, fh)
+    dump_pickle(content, fname, compression or pkl_compression)
 
 
 def pklload(suffix):
@@ -61,13 +75,140 @@ def pklload(suffix):
     fname = prefixed_pkl(suffix)
     print('Loading %s' % fname)
     ts = time.time()
-    with open(fname, 'rb') as fh:
-        content = pickle.load(fh)
+    content = load_pickle(fname)
     te = time.time()
     print('Loaded %s in %.1f seconds' % (fname, te-ts))
     return content
 
 
+def stmt_table_path(pkl_path=None):
+    """Return the folder of the columnar table built from a statement pickle.
+
+    If no pickle path is given, the table of the assembled corpus
+    (bioexp_asmb_preassembled.pkl) is used.
+    """
+    if pkl_path is None:
+        pkl_path = asmb_pkl
+    return os.path.splitext(pkl_path)[0] + '_table'
+
+
+def load_stmt_table(columns, table_dir=None):
+    """Memory-map a set of columns from a columnar statement table.
+
+    The table is built once from a statement pickle by running
+    `python -m bioexp.stmt_table <pickle>`, see bioexp.stmt_table for the
+    list of available columns. Only the requested columns are mapped, and
+    their content is only read from disk as it is accessed.
+
+    Parameters
+    ----------
+    columns : list[str]
+        Names of the columns to load, e.g., ['stmt_hash', 'belief'].
+    table_dir : Optional[str]
+        Folder containing the table. Default: the table of the assembled
+        corpus.
+
+    Returns
+    -------
+    dict
+        A dict of read-only numpy arrays keyed by column name.
+    """
+    if table_dir is None:
+        table_dir = stmt_table_path()
+    return {col: np.load(join(table_dir, '%s.npy' % col), mmap_mode='r')
+            for col in columns}
+
+
+def load_stmt_table_labels(column, table_dir=None):
+    """Return the list of labels that the codes of a categorical column
+    (e.g., ev_source_api or stmt_type) index into."""
+    if table_dir is None:
+        table_dir = stmt_table_path()
+    with open(join(table_dir, 'labels.json'), 'r') as fh:
+        return json.load(fh)[column]
+
+
+def load_stmts_by_hash(hashes, table_dir=None):
+    """Load the Statements with the given hashes from the statement table.
+
+    Each Statement is looked up by binary search in the hash index of the
+    table and unpickled from its own record, so the cost only depends on the
+    number of hashes requested. Note that the returned Statements have empty
+    supports/supported_by lists.
+
+    Parameters
+    ----------
+    hashes : iterable[int]
+        Statement hashes to look up.
+    table_dir : Optional[str]
+        Folder containing the table. Default: the table of the assembled
+        corpus.
+
+    Returns
+    -------
+    dict
+        A dict of Statements keyed by hash. Hashes that are not in the
+        table are omitted.
+    """
+    if table_dir is None:
+        table_dir = stmt_table_path()
+    index = load_stmt_table(['hash_sorted', 'hash_order', 'stmt_offset'],
+                            table_dir)
+    hashes = sorted(set(hashes))
+    positions = np.searchsorted(index['hash_sorted'], hashes)
+    stmts_by_hash = {}
+    with open(join(table_dir, 'stmt_records.bin'), 'rb') as fh:
+        for stmt_hash, pos in zip(hashes, positions):
+            if pos == len(index['hash_sorted']) or \
+                    index['hash_sorted'][pos] != stmt_hash:
+                continue
+            row = index['hash_order'][pos]
+            start, end = index['stmt_offset'][row:row+2]
+            fh.seek(start)
+            stmts_by_hash[stmt_hash] = pickle.loads(fh.read(end - start))
+    return stmts_by_hash
+
+
+# Source hash indexes of the evidences of Statements, keyed by id(stmt)
+_ev_indexes = {}
+
+
+def get_evidence_index(stmt):
+    """Return the evidences of a Statement grouped by their source hash.
+
+    The index is built once per Statement and cached in a side table, so
+    repeated lookups don't recompute the source hashes of all evidences.
+    The index is rebuilt if the evidence list of the Statement is replaced
+    or changes length, and is dropped when the Statement is garbage
+    collected.
+
+    Parameters
+    ----------
+    stmt : indra.statements.Statement
+        The Statement whose evidences are indexed.
+
+    Returns
+    -------
+    dict
+        Lists of the Statement's evidences (in their original order) keyed
+        by source hash. Evidences can share a source hash, e.g., if they
+        differ only in fields that are not part of the hash.
+    """
+    key = id(stmt)
+    cached = _ev_indexes.get(key)
+    if cached is not None:
+        evidence, num_ev, index = cached
+        if evidence is stmt.evidence and num_ev == len(evidence):
+            return index
+    else:
+        weakref.finalize(stmt, _ev_indexes.pop, key, None)
+    index = {}
+    for ev in stmt.evidence:
+        index.setdefault(ev.get_source_hash(), []).append(ev)
+    _ev_indexes[key] = (stmt.evidence, len(stmt.evidence), index)
+    return index
+
+
 def listify_dict(d):
     """Return a list by taking the union of dict entries that are lists."""
     ll = []
@@ -1,16 +1,232 @@
 import sys
+import hashlib
 from util import *
 import indra.tools.assemble_corpus as ac
 from indra.sources import signor
 from indra.mechlinker import MechLinker
 from scorer import CuratedScorer
+from incremental_preassembly import run_incremental_preassembly
+
+
+def get_raw_stmt_key(stmt):
+    """Return a 64-bit key identifying exact duplicates of a raw Statement.
+
+    Two raw Statements have the same key if they have the same matches key,
+    the same db_refs for each of their agents and evidences with the same
+    matches keys, in which case preassembly would merge them without adding
+    any evidence.
+    """
+    agents = stmt.agent_list(deep_sorted=True)
+    key = '%s%s%s' % (stmt.matches_key(),
+                      [None if ag is None else ag.db_refs for ag in agents],
+                      [ev.matches_key() for ev in stmt.evidence])
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8],
+                          'little')
+
+
+def iter_source_stmts(sources, drop_duplicates=False):
+    """Yield the Statements of each source pickle in turn.
+
+    Only one source is loaded at a time, so together with
+    dump_pickle_chunks, the sources can be combined with the memory needed
+    for the largest of them.
+
+    Parameters
+    ----------
+    sources : list[str]
+        The paths to the source pickles.
+    drop_duplicates : Optional[bool]
+        If True, exact duplicates (see get_raw_stmt_key) of Statements that
+        were yielded before are dropped. Preassembly merges them without
+        adding any evidence, so this only makes the later steps faster, but
+        it changes the number of raw Statements (e.g., in stmt_counts.py),
+        so it is off by default. The keys of the Statements are then held
+        in memory as well. Default: False
+    """
+    seen_keys = set()
+    for source in sources:
+        stmts = load_pickle(source)
+        num_loaded = len(stmts)
+        if drop_duplicates:
+            unique_stmts = []
+            for stmt in stmts:
+                key = get_raw_stmt_key(stmt)
+                if key not in seen_keys:
+                    seen_keys.add(key)
+                    unique_stmts.append(stmt)
+            stmts = unique_stmts
+            print('Loaded %d statements from %s, %d duplicates' %
+                  (num_loaded, source, num_loaded - len(stmts)))
+        else:
+            print('Loaded %d statements from %s' % (num_loaded, source))
+        yield stmts
+
+
+# The steps of the assembly pipeline before preassembly, in order, with
+# their arguments. Each of them processes Statements independently of each
+# other, so they can be applied to chunks of Statements.
+pipeline_steps = [
+    ('filter_no_hypothesis', {}),
+    ('map_grounding', {}),
+    ('filter_grounded_only', {}),
+    ('filter_genes_only', {'specific_only': False}),
+    ('filter_human_only', {}),
+    ('map_sequence', {}),
+    ]
+
+
+# The mappers used by the map_grounding and map_sequence steps, which are
+# created once and inherited by forked worker processes
+mappers = {}
+
+
+def get_mapper(step):
+    """Return the (cached) mapper used by a mapping step."""
+    if step not in mappers:
+        if step == 'map_grounding':
+            from indra.preassembler.grounding_mapper import GroundingMapper
+            mappers[step] = GroundingMapper()
+        elif step == 'map_sequence':
+            from indra.preassembler.sitemapper import SiteMapper, \
+                default_site_map
+            mappers[step] = SiteMapper(default_site_map)
+    return mappers[step]
+
+
+def map_grounding_chunk(stmts):
+    """Map the grounding of Statements like ac.map_grounding."""
+    from indra.statements import Translocation
+    stmts_out = get_mapper('map_grounding').map_stmts(stmts, do_rename=True)
+    # Patch wrong locations in Translocation statements
+    for stmt in stmts_out:
+        if isinstance(stmt, Translocation):
+            if not stmt.from_location:
+                stmt.from_location = None
+            if not stmt.to_location:
+                stmt.to_location = None
+    return stmts_out
+
+
+def map_sequence_chunk(stmts):
+    """Map the sites of Statements like ac.map_sequence, returning the
+    Statements with valid sites and the correctly mapped Statements
+    separately."""
+    valid, mapped = get_mapper('map_sequence').map_sites(stmts)
+    correctly_mapped_stmts = []
+    for ms in mapped:
+        if all([mm.has_mapping() for mm in ms.mapped_mods]):
+            correctly_mapped_stmts.append(ms.mapped_stmt)
+    return valid, correctly_mapped_stmts
+
+
+def map_parallel(step, stmts, processes, chunk_size=10000):
+    """Run map_grounding or map_sequence on chunks of Statements in
+    parallel.
+
+    The mapper is created before the worker processes are forked so that
+    they share its (read-only) mapping tables. The chunks are mapped in
+    order, and the output is the same, in the same order, as that of the
+    corresponding assemble_corpus function.
+    """
+    from multiprocessing import get_context
+    get_mapper(step)
+    chunks = [stmts[ix:ix+chunk_size]
+              for ix in range(0, len(stmts), chunk_size)]
+    with get_context('fork').Pool(processes) as pool:
+        results = pool.imap(globals()['%s_chunk' % step], chunks)
+        return merge_mapped(step, results)
+
+
+def merge_mapped(step, results):
+    """Concatenate the results of mapping chunks of Statements in order."""
+    if step == 'map_grounding':
+        stmts_out = []
+        for chunk_out in results:
+            stmts_out += chunk_out
+        return stmts_out
+    # As in ac.map_sequence, the Statements with valid sites come first
+    valid = []
+    mapped = []
+    for chunk_valid, chunk_mapped in results:
+        valid += chunk_valid
+        mapped += chunk_mapped
+    return valid + mapped
+
+
+def run_step(step, kwargs, chunks):
+    """Apply an assembly step to each chunk of a stream of Statements."""
+    if step == 'map_grounding':
+        for chunk in chunks:
+            yield map_grounding_chunk(chunk)
+    elif step == 'map_sequence':
+        # The correctly mapped Statements are passed on after all Statements
+        # with valid sites to keep the order of ac.map_sequence
+        mapped = []
+        for chunk in chunks:
+            valid, chunk_mapped = map_sequence_chunk(chunk)
+            mapped += chunk_mapped
+            yield valid
+        yield mapped
+    else:
+        fun = getattr(ac, step)
+        for chunk in chunks:
+            yield fun(chunk, **kwargs)
+
+
+def checkpoint(chunks, output_file):
+    """Pass a stream of Statements through, dumping all of them at the end."""
+    stmts = []
+    for chunk in chunks:
+        stmts += chunk
+        yield chunk
+    pkldump(stmts, output_file)
+
+
+def run_pipeline(stmts, checkpoints=None, chunk_size=100000):
+    """Run the assembly steps before preassembly in a single pass.
+
+    The Statements are split into chunks which are streamed through each
+    step in turn, instead of running each step on the full corpus and
+    pickling its output.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement]
+        The Statements to assemble.
+    checkpoints : Optional[dict]
+        Names of the outputs of steps to dump (e.g., {'map_sequence':
+        'asmb_map_sequence'}). The output of each of these steps is the
+        same as that of the corresponding separate command.
+    chunk_size : Optional[int]
+        The number of Statements per chunk. Default: 100000
+
+    Returns
+    -------
+    list[indra.statements.Statement]
+        The Statements after the last step.
+    """
+    checkpoints = checkpoints or {}
+    unknown_steps = set(checkpoints) - {step for step, _ in pipeline_steps}
+    if unknown_steps:
+        raise ValueError('Unknown steps: %s' % ', '.join(unknown_steps))
+    chunks = (stmts[ix:ix+chunk_size]
+              for ix in range(0, len(stmts), chunk_size))
+    for step, kwargs in pipeline_steps:
+        chunks = run_step(step, kwargs, chunks)
+        if step in checkpoints:
+            chunks = checkpoint(chunks, checkpoints[step])
+    assembled_stmts = []
+    for chunk in chunks:
+        assembled_stmts += chunk
+    return assembled_stmts
+
 
 if __name__ == '__main__':
     cmd = sys.argv[1]
     assembly_cmds = (
             'filter_no_hypothesis', 'map_grounding', 'filter_grounded_only',
             'filter_genes_only', 'filter_human_only', 'expand_families',
-            'map_sequence', 'preassembled')
+            'map_sequence', 'preassembled', 'preassembled_incremental')
     if cmd in assembly_cmds:
         input_file = sys.argv[2]
         output_file = sys.argv[3]
@@ -19,28 +235,42 @@ if __name__ == '__main__':
         sp = signor.process_from_web()
         pkldump(sp.statements, 'signor')
     elif cmd == 'load_stmts':
+        # load_stmts <output> [--drop_duplicates] <source pickles>
         output = sys.argv[2]
         sources = sys.argv[3:]
-        stmts = []
-        for source in sources:
-            stmts += ac.load_statements(source)
-        pkldump(stmts, output)
+        drop_duplicates = bool(sources) and sources[0] == '--drop_duplicates'
+        if drop_duplicates:
+            sources = sources[1:]
+        num_stmts = dump_pickle_chunks(
+            iter_source_stmts(sources, drop_duplicates),
+            prefixed_pkl(output), pkl_compression)
+        print('Dumped %d statements into %s' % (num_stmts,
+                                               prefixed_pkl(output)))
     elif cmd == 'filter_no_hypothesis':
         stmts = pklload(input_file)
-        stmts = ac.filter_no_hypothesis(stmts, save=prefixed_pkl(output_file))
+        stmts = ac.filter_no_hypothesis(stmts)
+        pkldump(stmts, output_file)
+    # Mapping steps take the number of processes as an optional argument
+    elif cmd == 'map_grounding' and len(sys.argv) > 4:
+        stmts = pklload(input_file)
+        stmts = map_parallel(cmd, stmts, int(sys.argv[4]))
+        pkldump(stmts, output_file)
     elif cmd == 'map_grounding':
         stmts = pklload(input_file)
-        stmts = ac.map_grounding(stmts, save=prefixed_pkl(output_file))
+        stmts = ac.map_grounding(stmts)
+        pkldump(stmts, output_file)
     elif cmd == 'filter_grounded_only':
         stmts = pklload(input_file)
-        stmts = ac.filter_grounded_only(stmts, save=prefixed_pkl(output_file))
+        stmts = ac.filter_grounded_only(stmts)
+        pkldump(stmts, output_file)
     elif cmd == 'filter_genes_only':
         stmts = pklload(input_file)
-        stmts = ac.filter_genes_only(stmts, specific_only=False,
-                                     save=prefixed_pkl(output_file))
+        stmts = ac.filter_genes_only(stmts, specific_only=False)
+        pkldump(stmts, output_file)
     elif cmd == 'filter_human_only':
         stmts = pklload(input_file)
-        stmts = ac.filter_human_only(stmts, save=prefixed_pkl(output_file))
+        stmts = ac.filter_human_only(stmts)
+        pkldump(stmts, output_file)
     elif cmd == 'filter_source':
         input_file = sys.argv[2]
         source_name = sys.argv[3]
@@ -48,14 +278,44 @@ if __name__ == '__main__':
         stmts = pklload(input_file)
         filt_stmts = [s for s in stmts
                       if s.evidence[0].source_api == source_name]
-        ac.dump_statements(filt_stmts, prefixed_pkl(output_file))
+        pkldump(filt_stmts, output_file)
+    elif cmd == 'map_sequence' and len(sys.argv) > 4:
+        stmts = pklload(input_file)
+        stmts = map_parallel(cmd, stmts, int(sys.argv[4]))
+        pkldump(stmts, output_file)
     elif cmd == 'map_sequence':
         stmts = pklload(input_file)
-        stmts = ac.map_sequence(stmts, save=prefixed_pkl(output_file))
+        stmts = ac.map_sequence(stmts)
+        pkldump(stmts, output_file)
     elif cmd == 'preassembled':
         stmts = pklload(input_file)
         cur_scorer = CuratedScorer()
         stmts = ac.run_preassembly(stmts, return_toplevel=False,
                                    belief_scorer=cur_scorer,
-                                   save=prefixed_pkl(output_file),
                                    poolsize=16)
+        pkldump(stmts, output_file)
+    # The state of the last run is kept in <output_file>_state
+    elif cmd == 'preassembled_incremental':
+        stmts = pklload(input_file)
+        cur_scorer = CuratedScorer()
+        stmts = run_incremental_preassembly(
+            stmts, prefixed_pkl(output_file + '_state'),
+            belief_scorer=cur_scorer)
+        pkldump(stmts, output_file)
+    # Run all steps from filter_no_hypothesis to preassembled in one process,
+    # e.g., pipeline all_raw asmb_preassembled map_sequence=asmb_map_sequence
+    # where the optional step=name arguments dump the outputs of steps
+    elif cmd == 'pipeline':
+        input_file = sys.argv[2]
+        output_file = sys.argv[3]
+        checkpoints = {}
+        for arg in sys.argv[4:]:
+            step, _, name = arg.partition('=')
+            checkpoints[step] = name or step
+        stmts = pklload(input_file)
+        stmts = run_pipeline(stmts, checkpoints)
+        cur_scorer = CuratedScorer()
+        stmts = ac.run_preassembly(stmts, return_toplevel=False,
+                                   belief_scorer=cur_scorer,
+                                   poolsize=16)
+        pkldump(stmts, output_file)
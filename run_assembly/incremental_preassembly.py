@@ -0,0 +1,322 @@
+"""Incremental preassembly of a growing corpus of Statements.
+
+Running preassembly on the full corpus whenever new reading output is added
+repeats the deduplication, refinement finding and belief calculation for all
+of the Statements that didn't change. Instead, the state of the last run is
+persisted: the unique Statements keyed by their matches_key together with
+the keys of the evidences they were built from, and the index of the
+ontology refinement filter. New raw Statements are merged into this state,
+refinements are only looked for between the new unique Statements and all
+others, and beliefs are only recalculated for the Statements whose evidence
+or more specific Statements changed.
+
+The output is equivalent to that of ac.run_preassembly with
+return_toplevel=False, up to the order of the supports/supported_by lists,
+the uuids of unique Statements and which duplicate raw Statement's uuid is
+recorded in the prior_uuids of an evidence, all of which are arbitrary in
+either case.
+Raw Statements can only be added; if any of the raw Statements of the last
+run are missing from the input, or INDRA or its ontology changed, the state
+is rebuilt from scratch. The state should also be deleted if the belief
+scorer changed, since the beliefs of unaffected Statements are kept.
+"""
+import os
+import pickle
+import hashlib
+import logging
+import indra
+from indra.belief import BeliefEngine, build_refinements_graph
+from indra.ontology.bio import bio_ontology
+from indra.preassembler import find_refinements_for_statement
+from indra.preassembler.refinement import OntologyRefinementFilter, \
+    RefinementConfirmationFilter, get_relevant_keys
+from indra.statements import stmt_type as indra_stmt_type
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_state_version():
+    """Return the versions that a preassembly state is only valid for."""
+    return indra.__version__, bio_ontology.version
+
+
+class PreassemblyState(object):
+    """The deduplicated Statements and refinement index of a preassembly run.
+
+    Attributes
+    ----------
+    version : tuple
+        The INDRA and ontology versions the state was built with.
+    unique_stmts : dict[str, indra.statements.Statement]
+        The unique Statements keyed by their matches_key, with their
+        supports/supported_by links and beliefs set.
+    ev_keys : set[bytes]
+        Digests of the keys of all evidences merged into the unique
+        Statements, see get_raw_keys.
+    ontology_index : dict
+        The data of the OntologyRefinementFilter for the unique Statements
+        (except for the Statements themselves).
+    """
+    def __init__(self):
+        self.version = get_state_version()
+        self.unique_stmts = {}
+        self.ev_keys = set()
+        self.ontology_index = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['ontology_index'] = {k: v for k, v in
+                                   self.ontology_index.items()
+                                   if k != 'stmts_by_hash'}
+        return state
+
+    @staticmethod
+    def get_raw_keys(stmts):
+        """Return the matches_key of each raw Statement and the digests of
+        the keys of its evidences.
+
+        As in Preassembler.combine_duplicate_stmts, an evidence is a
+        duplicate of another if they have the same matches_key and the
+        raw text and grounding of their Statements' agents are the same.
+        """
+        raw_keys = []
+        for stmt in stmts:
+            key = stmt.matches_key()
+            agents = stmt.agent_list(deep_sorted=True)
+            raw_text = [None if ag is None else ag.db_refs.get('TEXT')
+                        for ag in agents]
+            raw_grounding = [None if ag is None else ag.db_refs
+                             for ag in agents]
+            agents_key = str(raw_text) + str(raw_grounding)
+            ev_keys = [hashlib.md5((key + ev.matches_key() +
+                                    agents_key).encode('utf-8')).digest()
+                       for ev in stmt.evidence]
+            raw_keys.append((key, ev_keys, raw_text, raw_grounding))
+        return raw_keys
+
+    def has_all_evidence(self, raw_keys):
+        """Return True if all evidences merged into the state are among
+        those of the given raw Statements."""
+        seen = set()
+        for _, ev_keys, _, _ in raw_keys:
+            seen.update(ev_key for ev_key in ev_keys
+                        if ev_key in self.ev_keys)
+        return len(seen) == len(self.ev_keys)
+
+    def merge(self, stmts, raw_keys):
+        """Merge the evidences of raw Statements that are not in the state
+        yet into the unique Statements.
+
+        Parameters
+        ----------
+        stmts : list[indra.statements.Statement]
+            Raw Statements, whose evidences are added to the unique
+            Statements.
+        raw_keys : list[tuple]
+            The keys of the raw Statements as returned by get_raw_keys.
+
+        Returns
+        -------
+        new_keys : set[str]
+            The matches keys of the unique Statements that were added.
+        changed_keys : set[str]
+            The matches keys of the existing unique Statements that got new
+            evidence.
+        """
+        new_keys = set()
+        changed_keys = set()
+        for stmt, (key, ev_keys, raw_text, raw_grounding) in \
+                zip(stmts, raw_keys):
+            unique_stmt = self.unique_stmts.get(key)
+            if unique_stmt is None:
+                unique_stmt = stmt.make_generic_copy()
+                unique_stmt.uuid = stmt.uuid
+                self.unique_stmts[key] = unique_stmt
+                new_keys.add(key)
+            for ev, ev_key in zip(stmt.evidence, ev_keys):
+                if ev_key in self.ev_keys:
+                    continue
+                if key not in new_keys:
+                    changed_keys.add(key)
+                if 'agents' in ev.annotations:
+                    ev.annotations['agents']['raw_text'] = raw_text
+                    ev.annotations['agents']['raw_grounding'] = \
+                        raw_grounding
+                else:
+                    ev.annotations['agents'] = \
+                        {'raw_text': raw_text,
+                         'raw_grounding': raw_grounding}
+                if 'prior_uuids' not in ev.annotations:
+                    ev.annotations['prior_uuids'] = []
+                ev.annotations['prior_uuids'].append(stmt.uuid)
+                unique_stmt.evidence.append(ev)
+                self.ev_keys.add(ev_key)
+        # Refresh the hashes of Statements whose evidence changed
+        for key in new_keys | changed_keys:
+            for shallow in (True, False):
+                self.unique_stmts[key].get_hash(shallow=shallow,
+                                                refresh=True)
+        logger.info('Merged %d raw statements into %d new and %d changed '
+                    'unique statements' % (len(stmts), len(new_keys),
+                                           len(changed_keys)))
+        return new_keys, changed_keys
+
+    def find_refinements(self, new_keys):
+        """Link new unique Statements to the Statements they refine and to
+        the existing Statements that refine them.
+
+        Refinements between existing Statements don't depend on other
+        Statements, so only pairs involving a new Statement are compared.
+        """
+        stmts_by_hash = {stmt.get_hash(): stmt
+                         for stmt in self.unique_stmts.values()}
+        new_by_hash = {self.unique_stmts[key].get_hash():
+                       self.unique_stmts[key] for key in new_keys}
+        ontology_filter = OntologyRefinementFilter(ontology=bio_ontology)
+        ontology_filter.shared_data = self.ontology_index
+        ontology_filter.shared_data['stmts_by_hash'] = stmts_by_hash
+        if new_by_hash:
+            ontology_filter.extend(new_by_hash)
+        confirm_filter = RefinementConfirmationFilter(ontology=bio_ontology)
+        confirm_filter.initialize(stmts_by_hash)
+        filters = [ontology_filter, confirm_filter]
+
+        relations = []
+        for stmt_hash, stmt in new_by_hash.items():
+            # Statements (new or existing) that the new one refines
+            for refined in find_refinements_for_statement(stmt, filters):
+                relations.append((stmt_hash, refined))
+            # Existing Statements that refine the new one
+            candidates = self._get_refiner_candidates(stmt, stmt_hash,
+                                                      new_by_hash)
+            for refiner in confirm_filter.get_more_specifics(
+                    stmt, possibly_related=candidates):
+                relations.append((refiner, stmt_hash))
+        for refiner, refined in relations:
+            stmts_by_hash[refiner].supported_by.append(stmts_by_hash[refined])
+            stmts_by_hash[refined].supports.append(stmts_by_hash[refiner])
+        logger.info('Found %d refinements for %d new unique statements '
+                    'with %d comparisons' % (len(relations),
+                                             len(new_by_hash),
+                                             confirm_filter.comparison_counter))
+
+    def _get_refiner_candidates(self, stmt, stmt_hash, new_by_hash):
+        """Return the hashes of existing Statements for which the ontology
+        filter would find the given Statement as a possible refinement."""
+        index = self.ontology_index.get(indra_stmt_type(stmt))
+        if index is None:
+            return set()
+        # A Statement can only refine this one if each of its agent keys in
+        # a role is the same as or a child of one of this Statement's agent
+        # keys in the role, or this Statement has a None key in the role
+        candidates = None
+        for role, hash_to_agent_key in index['hash_to_agent_key'].items():
+            agent_keys = hash_to_agent_key[stmt_hash]
+            if None in agent_keys:
+                continue
+            role_candidates = set()
+            for agent_key in agent_keys:
+                for key in {agent_key} | \
+                        set(bio_ontology.get_children(*agent_key)):
+                    role_candidates |= \
+                        index['agent_key_to_hash'][role].get(key, set())
+            candidates = role_candidates if candidates is None \
+                else candidates & role_candidates
+        if candidates is None:
+            candidates = set().union(*index['hash_to_agent_key'].values())
+        candidates -= set(new_by_hash)
+        # Keep only the candidates that pass the filter exactly as they would
+        # when looking for the less specific Statements of each candidate
+        return {candidate for candidate in candidates
+                if self._ontology_refines(index, candidate, stmt_hash)}
+
+    @staticmethod
+    def _ontology_refines(index, refiner, refined):
+        for role, hash_to_agent_key in index['hash_to_agent_key'].items():
+            refined_keys = hash_to_agent_key[refined]
+            for agent_key in hash_to_agent_key[refiner]:
+                relevant_keys = get_relevant_keys(
+                    agent_key, index['all_keys_by_role'][role],
+                    bio_ontology, direction='less_specific')
+                if not relevant_keys & refined_keys:
+                    return False
+        return True
+
+    def set_beliefs(self, keys, belief_scorer=None):
+        """Recalculate the beliefs of the given unique Statements and of all
+        the less specific Statements they support."""
+        affected = {}
+        stack = [self.unique_stmts[key] for key in keys]
+        while stack:
+            stmt = stack.pop()
+            stmt_hash = stmt.get_hash()
+            if stmt_hash not in affected:
+                affected[stmt_hash] = stmt
+                stack += stmt.supported_by
+        graph = build_refinements_graph(list(self.unique_stmts.values()))
+        be = BeliefEngine(scorer=belief_scorer, refinements_graph=graph)
+        be.set_prior_probs([self.unique_stmts[key] for key in keys])
+        be.set_hierarchy_probs(list(affected.values()))
+        logger.info('Set beliefs of %d statements' % len(affected))
+
+    def get_statements(self):
+        """Return the unique Statements in the order of a full
+        preassembly run."""
+        return [self.unique_stmts[key] for key in sorted(self.unique_stmts)]
+
+
+def load_state(state_file):
+    """Return the preassembly state in a file, or None if there is no
+    (valid) state."""
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, 'rb') as fh:
+        state = pickle.load(fh)
+    if state.version != get_state_version():
+        logger.info('Preassembly state in %s is from versions %s, '
+                    'discarding it' % (state_file, state.version))
+        return None
+    return state
+
+
+def dump_state(state, state_file):
+    """Dump a preassembly state into a file atomically."""
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'wb') as fh:
+        pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, state_file)
+
+
+def run_incremental_preassembly(stmts, state_file, belief_scorer=None):
+    """Preassemble Statements, reusing the state of the last run.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement]
+        All raw Statements of the corpus, including those that were
+        preassembled in the last run. The evidences of new Statements are
+        modified and become part of the output.
+    state_file : str
+        The path to the pickled preassembly state, which is created if it
+        doesn't exist and is updated with the new Statements.
+    belief_scorer : Optional[indra.belief.BeliefScorer]
+        The belief scorer to use. If None, the default scorer is used.
+
+    Returns
+    -------
+    list[indra.statements.Statement]
+        All unique Statements with their refinements and beliefs set, as
+        returned by ac.run_preassembly with return_toplevel=False.
+    """
+    state = load_state(state_file) or PreassemblyState()
+    raw_keys = state.get_raw_keys(stmts)
+    if not state.has_all_evidence(raw_keys):
+        logger.info('Some raw statements of the last run are missing, '
+                    'rebuilding the preassembly state')
+        state = PreassemblyState()
+    new_keys, changed_keys = state.merge(stmts, raw_keys)
+    state.find_refinements(new_keys)
+    state.set_beliefs(new_keys | changed_keys, belief_scorer)
+    dump_state(state, state_file)
+    return state.get_statements()
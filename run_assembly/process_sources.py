@@ -1,17 +1,22 @@
 import os
 import sys
 import gzip
+import time
 import json
 import glob
 import shutil
+import hashlib
 import pickle
 import zipfile
 import tarfile
 import logging
+import itertools
+import threading
+import urllib.error
 import urllib.request
-from collections import Counter
+from collections import Counter, defaultdict
 from indra.sources import reach, trips, medscan, sparser
-from indra.preassembler.grounding_mapper.gilda import ground_statements
+from bioexp.memory import get_num_processes
 from bioexp.transfer_s3 import download_from_s3, upload_to_s3
 
 
@@ -22,6 +27,150 @@ with open(pmid_file, 'r') as fh:
     pmids = [l.strip() for l in fh.readlines()]
 
 
+def download_file(url, data_folder, fname=None, sha256=None):
+    """Download a file into a folder unless an up-to-date copy is there.
+
+    A sidecar file (<fname>.download.json) records the URL, ETag, size and
+    SHA-256 checksum of each completed download. A local copy is reused if
+    it was downloaded from the same URL, has the recorded size and
+    checksum, and the ETag and size reported by the server (if reachable)
+    are unchanged, so that sources can be reprocessed offline. Interrupted
+    downloads are resumed from the partial <fname>.part file if the server
+    supports range requests and reports the same ETag (or, if it doesn't
+    report one, the same Last-Modified date and size) as when the download
+    started. Otherwise, or if the server rejects the range, the download
+    starts over.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the file.
+    data_folder : str
+        The folder in which the file is stored.
+    fname : Optional[str]
+        The name of the local file. Default: the last part of the URL.
+    sha256 : Optional[str]
+        The expected SHA-256 checksum of the file, if known.
+
+    Returns
+    -------
+    str
+        The path to the local copy of the file.
+    """
+    fname = os.path.join(data_folder, fname or url.split('/')[-1])
+    meta_fname = fname + '.download.json'
+    part_fname = fname + '.part'
+    meta = {}
+    if os.path.exists(meta_fname):
+        with open(meta_fname, 'r') as fh:
+            meta = json.load(fh)
+    remote = _get_remote_info(url)
+
+    if meta.get('url') == url and os.path.exists(fname) and \
+            os.path.getsize(fname) == meta['size'] and \
+            (sha256 is None or sha256 == meta['sha256']) and \
+            (remote is None or
+             (remote['etag'] in (None, meta['etag']) and
+              remote['size'] in (None, meta['size']))):
+        logger.info('Using downloaded %s' % fname)
+        return fname
+    if remote is None:
+        raise ValueError('Could not reach %s and there is no downloaded '
+                         'copy in %s' % (url, fname))
+
+    # Resume a partial download of the same version of the file
+    offset = 0
+    if os.path.exists(part_fname) and meta.get('url') == url and \
+            remote['ranges'] and _is_same_version(meta, remote):
+        offset = os.path.getsize(part_fname)
+    meta = {'url': url, 'etag': remote['etag'],
+            'last_modified': remote['last_modified'],
+            'remote_size': remote['size'], 'size': None, 'sha256': None}
+    with open(meta_fname, 'w') as fh:
+        json.dump(meta, fh, indent=1)
+
+    if offset and offset == remote['size']:
+        # The download was interrupted after it completed
+        logger.info('Using complete partial download %s' % part_fname)
+    else:
+        logger.info('Downloading %s into %s' % (url, fname))
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            # The range isn't satisfiable, e.g., because the partial
+            # download is complete, so it can't be verified without
+            # starting over
+            if not offset or e.code != 416:
+                raise
+            logger.info('Could not resume %s, starting over' % part_fname)
+            offset = 0
+            response = urllib.request.urlopen(urllib.request.Request(url))
+        with response:
+            if offset and response.status != 206:
+                offset = 0
+            with open(part_fname, 'ab' if offset else 'wb') as fh:
+                shutil.copyfileobj(response, fh, 1024 * 1024)
+
+    digest = _sha256_file(part_fname)
+    if sha256 is not None and digest != sha256:
+        os.remove(part_fname)
+        raise ValueError('Checksum mismatch for %s' % url)
+    os.replace(part_fname, fname)
+    meta.update({'size': os.path.getsize(fname), 'sha256': digest})
+    with open(meta_fname, 'w') as fh:
+        json.dump(meta, fh, indent=1)
+    return fname
+
+
+def _get_remote_info(url):
+    # Return the ETag, Last-Modified date and size of a URL, or None if it
+    # can't be reached. If the server doesn't allow HEAD requests, the
+    # headers of a GET request are used instead (without reading the body).
+    for method in ('HEAD', 'GET'):
+        request = urllib.request.Request(url, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                size = response.headers.get('Content-Length')
+                return {'etag': response.headers.get('ETag'),
+                        'last_modified':
+                        response.headers.get('Last-Modified'),
+                        'size': int(size) if size is not None else None,
+                        'ranges': response.headers.get('Accept-Ranges') ==
+                        'bytes'}
+        except urllib.error.HTTPError as e:
+            error = e
+            if method == 'HEAD':
+                logger.info('HEAD request for %s failed (%s), trying GET' %
+                            (url, e))
+        except OSError as e:
+            error = e
+            break
+    logger.info('Could not reach %s: %s' % (url, error))
+    return None
+
+
+def _is_same_version(meta, remote):
+    # Return True if a partial download is of the same version of the file
+    # as the one on the server, which can only be told if the server
+    # reports an ETag or a Last-Modified date
+    if remote['etag'] is not None:
+        return meta.get('etag') == remote['etag']
+    return remote['last_modified'] is not None and \
+        meta.get('last_modified') == remote['last_modified'] and \
+        meta.get('remote_size') == remote['size']
+
+
+def _sha256_file(fname):
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
 def process_source(source, cached, data_folder, target_folder):
     logger.info('Processing %s' % source)
     key = 'bioexp_%s.pkl' % source
@@ -38,21 +187,190 @@ def process_source(source, cached, data_folder, target_folder):
         upload_to_s3(fname)
 
 
+# Number of PMIDs or input files whose Statements are written into one shard
+pmids_per_shard = 1000
+files_per_shard = 100
+
+
+class ShardWriter(object):
+    """Write the Statements of a source in shards as they are processed.
+
+    The units of processing (e.g., PMIDs or input files) are split into
+    consecutive shards. Once all units of a shard were added, the shard's
+    Statements are pickled into shard_<ix>.pkl in the shard folder and the
+    shard is recorded as done in manifest.json, so that if processing is
+    interrupted, a rerun only needs to process the units of the shards
+    that aren't done yet (see pending_units). The manifest is reset if the
+    list of units or the shard size changes.
+
+    Parameters
+    ----------
+    shard_folder : str
+        The folder in which the shards and the manifest are written.
+    units : list[str]
+        The units of processing in the order in which their Statements are
+        merged.
+    shard_size : int
+        The number of units per shard.
+    """
+    def __init__(self, shard_folder, units, shard_size):
+        self.shard_folder = shard_folder
+        units = list(dict.fromkeys(units))
+        self.shards = [units[ix:ix+shard_size]
+                       for ix in range(0, len(units), shard_size)]
+        self.shard_of = {unit: ix for ix, shard in enumerate(self.shards)
+                         for unit in shard}
+        self.added = defaultdict(dict)
+        os.makedirs(shard_folder, exist_ok=True)
+        self.manifest_fname = os.path.join(shard_folder, 'manifest.json')
+        units_hash = hashlib.sha256('\n'.join(units).encode()).hexdigest()
+        self.manifest = {}
+        if os.path.exists(self.manifest_fname):
+            with open(self.manifest_fname, 'r') as fh:
+                self.manifest = json.load(fh)
+        if self.manifest.get('units_hash') != units_hash or \
+                self.manifest.get('shard_size') != shard_size:
+            self.manifest = {'units_hash': units_hash,
+                             'shard_size': shard_size, 'done': {}}
+            self._dump_manifest()
+        logger.info('%d of %d shards in %s are done' %
+                    (len(self.manifest['done']), len(self.shards),
+                     shard_folder))
+
+    def pending_units(self):
+        """Return the units of the shards that aren't done."""
+        return [unit for ix, shard in enumerate(self.shards)
+                if str(ix) not in self.manifest['done'] for unit in shard]
+
+    def add(self, unit, stmts):
+        """Add the Statements of a unit, writing its shard if complete."""
+        ix = self.shard_of[unit]
+        self.added[ix][unit] = stmts
+        if len(self.added[ix]) < len(self.shards[ix]):
+            return
+        shard_stmts = []
+        for shard_unit in self.shards[ix]:
+            shard_stmts += self.added[ix][shard_unit]
+        _dump_atomic(shard_stmts, self._shard_fname(ix))
+        del self.added[ix]
+        self.manifest['done'][str(ix)] = len(shard_stmts)
+        self._dump_manifest()
+
+    def merge(self):
+        """Return the Statements of all shards in the order of the units."""
+        num_pending = len(self.shards) - len(self.manifest['done'])
+        if num_pending:
+            raise ValueError('%d shards in %s are not done' %
+                             (num_pending, self.shard_folder))
+        stmts = []
+        for ix in range(len(self.shards)):
+            with open(self._shard_fname(ix), 'rb') as fh:
+                stmts += pickle.load(fh)
+        return stmts
+
+    def _shard_fname(self, ix):
+        return os.path.join(self.shard_folder, 'shard_%05d.pkl' % ix)
+
+    def _dump_manifest(self):
+        tmp_fname = self.manifest_fname + '.tmp'
+        with open(tmp_fname, 'w') as fh:
+            json.dump(self.manifest, fh, indent=1)
+        os.replace(tmp_fname, self.manifest_fname)
+
+
+def get_shard_writer(source, data_folder, units, shard_size):
+    """Return a ShardWriter for a source in the data folder."""
+    shard_folder = os.path.join(data_folder, 'bioexp_%s_shards' % source)
+    return ShardWriter(shard_folder, units, shard_size)
+
+
+# The memory a worker process processing a source may need at most
+worker_memory = 2 * 1024 ** 3
+
+
+def process_into_shards(process_fun, writer, inputs=None, processes=None,
+                        chunksize=None):
+    """Process units in a pool of processes and stream them into shards.
+
+    Parameters
+    ----------
+    process_fun : function
+        A module-level function that takes an input and returns a unit of
+        the writer and the list of Statements processed from it.
+    writer : ShardWriter
+        The writer to which the Statements of each unit are added as soon
+        as they are processed.
+    inputs : Optional[iterable]
+        The inputs of process_fun. Default: the pending units of the writer
+    processes : Optional[int]
+        The number of processes. Default: get_num_processes(worker_memory)
+    chunksize : Optional[int]
+        The number of inputs sent to a process at a time. Default: chosen
+        so that each process gets about 4 chunks (at most 100 inputs per
+        chunk), or 10 if the number of inputs isn't known. At most two
+        chunks per process are taken from the inputs ahead of the results
+        that were added to the writer, so that inputs generated on the fly
+        (e.g., fetched reader outputs) don't pile up in memory.
+
+    Returns
+    -------
+    list[indra.statements.Statement]
+        The merged Statements of all shards of the writer.
+    """
+    from multiprocessing import Pool
+    if inputs is None:
+        inputs = writer.pending_units()
+    processes = processes or get_num_processes(worker_memory)
+    if chunksize is None:
+        chunksize = max(1, min(100, len(inputs) // (4 * processes))) \
+            if hasattr(inputs, '__len__') else 10
+    logger.info('Processing with %d processes' % processes)
+    # The pool takes inputs as fast as it can, so the number of inputs that
+    # were taken but whose results weren't consumed yet is bounded here
+    pending = threading.Semaphore(2 * processes * chunksize)
+    stopped = threading.Event()
+
+    def throttled_inputs():
+        for inp in inputs:
+            while not pending.acquire(timeout=1):
+                if stopped.is_set():
+                    return
+            yield inp
+
+    with Pool(processes) as pool:
+        try:
+            for unit, stmts in pool.imap_unordered(process_fun,
+                                                   throttled_inputs(),
+                                                   chunksize=chunksize):
+                pending.release()
+                writer.add(unit, stmts)
+        finally:
+            # Let the pool's task handler finish if the loop is left early
+            stopped.set()
+    return writer.merge()
+
+
+def _dump_atomic(content, fname):
+    # Pickle into a temporary file first so that an interrupted dump
+    # doesn't leave a partial file behind
+    with open(fname + '.tmp', 'wb') as fh:
+        pickle.dump(content, fh)
+    os.replace(fname + '.tmp', fname)
+
+
 def process_pathway_commons(data_folder):
-    # Reetreive the OWL file and put it in the data folder
+    # Reetreive the gzipped OWL file and put it in the data folder
     url = 'https://www.pathwaycommons.org/archives/PC2/v12/' + \
         'PathwayCommons12.All.BIOPAX.owl.gz'
-    fname = os.path.join(data_folder, 'PathwayCommons12.All.BIOPAX.owl')
-    logger.info('Downloading %s and extracting into %s' % (url, fname))
-    gz_file = os.path.join(data_folder, 'PathwayCommons12.All.BIOPAX.owl.gz')
-    urllib.request.urlretrieve(url, gz_file)
-    with gzip.open(gz_file, 'rb') as fin:
-        with open(fname, 'wb') as fout:
-            shutil.copyfileobj(fin, fout)
-
-    # Now process the OWL file to Statements
+    gz_file = download_file(url, data_folder)
+
+    # Now process the OWL file to Statements, decompressing it on the fly
+    # rather than extracting it to disk first
+    from pybiopax import model_from_owl_gz
     from indra.sources import biopax
-    bp = biopax.process_owl(fname)
+    logger.info('Processing %s' % gz_file)
+    model = model_from_owl_gz(gz_file, encoding='utf-8')
+    bp = biopax.process_model(model)
 
     # Now filter out phosphosite
     stmts = [s for s in bp.statements if
@@ -69,8 +387,7 @@ def process_bel(data_folder):
     from indra.sources import bel
     url = 'https://arty.scai.fraunhofer.de/artifactory/bel/knowledge/' + \
         'large_corpus/large_corpus-20170611.bel'
-    fname = os.path.join(data_folder, 'large_corpus-20170611.bel')
-    urllib.request.urlretrieve(url, fname)
+    fname = download_file(url, data_folder)
     bp = bel.process_belscript(fname)
     return bp.statements
 
@@ -90,9 +407,8 @@ def process_rlimsp(data_folder):
     stmts = []
     for fname, id_type in ((medline_file, 'pmid'), (pmc_file, 'pmcid')):
         logger.info('Processing %s' % fname)
-        out_file = os.path.join(data_folder, fname)
         url = rlimsp_url + fname
-        urllib.request.urlretrieve(url, out_file)
+        out_file = download_file(url, data_folder)
         rp = rlimsp.process_from_json_file(out_file, id_type)
         stmts += rp.statements
 
@@ -120,10 +436,9 @@ def process_phosphosite(data_folder):
 def process_cbn(data_folder):
     from indra.sources import bel
     url = 'http://causalbionet.com/Content/jgf_bulk_files/Human-2.0.zip'
-    zip_file = os.path.join(data_folder, 'Human-2.0.zip')
-    urllib.request.urlretrieve(url, zip_file)
+    zip_file = download_file(url, data_folder)
     cbn_folder = os.path.join(data_folder, 'cbn')
-    os.mkdir(cbn_folder)
+    os.makedirs(cbn_folder, exist_ok=True)
     with zipfile.ZipFile(zip_file) as fh:
         fh.extractall(path=cbn_folder)
     stmts = []
@@ -143,8 +458,7 @@ def process_hprd(data_folder):
     from indra.sources import hprd
     tgz_fname = 'HPRD_FLAT_FILES_041310.tar.gz'
     url = 'http://www.hprd.org/RELEASE9/%s' % tgz_fname
-    local_tgz_fname = os.path.join(data_folder, tgz_fname)
-    urllib.request.urlretrieve(url, local_tgz_fname)
+    local_tgz_fname = download_file(url, data_folder)
     with tarfile.open(local_tgz_fname, 'r:gz') as fh:
         fh.extractall(data_folder)
     hprd_path = os.path.join(data_folder, 'FLAT_FILES_072010')
@@ -166,29 +480,25 @@ def process_hprd(data_folder):
 def _process_medscan_get_stmts(fname):
     mp = medscan.process_file(fname)
     if mp:
-        return mp.statements
+        return fname, mp.statements
     else:
-        return []
+        return fname, []
 
 
 def process_medscan(data_folder):
     # NOTE: this function has not been run as is, unexpected issues could
     # come up
-    from multiprocessing import Pool
     # Process PMID file first
     pmid_file = os.path.join(data_folder, 'medscan', 'DARPAcorpus.csxml')
     mp = medscan.process_file(pmid_file)
     pmid_stmts = mp.statements
     # Process PMC files next
     file_pattern = os.path.join(data_folder, 'medscan', 'pmids', '*.csxml')
-    fnames = glob.glob(file_pattern)
-    # Now process files in parallel
-    pool = Pool(4)
-    stmts_ll = pool.map(_process_medscan_get_stmts, fnames)
-    # Flatten the list of lists
-    stmts = []
-    for sts in stmts_ll:
-        stmts += sts
+    fnames = sorted(glob.glob(file_pattern))
+    # Now process files in parallel, writing shards of their statements
+    writer = get_shard_writer('medscan', data_folder, fnames,
+                              files_per_shard)
+    stmts = process_into_shards(_process_medscan_get_stmts, writer)
     # Only add PMID statements if their PMID isn't covered by PMC
     pmc_pmids = {s.evidence[0].pmid for s in stmts}
     for stmt in pmid_stmts:
@@ -197,27 +507,166 @@ def process_medscan(data_folder):
     return stmts
 
 
-def _process_reach_pmid(pmid):
-    from indra.literature import s3_client
+# Number of threads fetching reader outputs from S3, number of attempts per
+# fetch and the S3 endpoint (e.g., a local S3 stand-in for testing, None
+# for AWS)
+s3_fetch_workers = 16
+# The number of outputs fetched ahead per fetching thread
+max_pending_fetches = 2
+s3_fetch_attempts = 3
+s3_endpoint_url = os.environ.get('BIOEXP_S3_ENDPOINT_URL')
+
+
+def _get_s3_client(max_workers):
+    import boto3
+    from botocore.config import Config
+    # The connection pool is sized so that all threads reuse connections
+    return boto3.client('s3', endpoint_url=s3_endpoint_url,
+                        config=Config(max_pool_connections=max_workers))
+
+
+def _fetch_reader_json_str(client, reader, pmid, cache_folder):
+    from botocore.exceptions import ClientError
+    from indra.literature.s3_client import bucket_name, get_reader_key
+    cache_file = os.path.join(cache_folder, reader, '%s.json.gz' % pmid) \
+        if cache_folder else None
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as fh:
+            reader_gz = fh.read()
+    else:
+        for attempt in range(s3_fetch_attempts):
+            try:
+                obj = client.get_object(Bucket=bucket_name,
+                                        Key=get_reader_key(reader, pmid))
+                reader_gz = obj['Body'].read()
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchKey':
+                    logger.info('No %s output found on S3 for %s' %
+                                (reader, pmid))
+                    return None
+                error = e
+            except Exception as e:
+                error = e
+            if attempt + 1 < s3_fetch_attempts:
+                time.sleep(2 ** attempt)
+        else:
+            # Raised rather than treated like a missing output, so that the
+            # PMID is fetched again when processing is resumed
+            raise error
+        if cache_file:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # Write to a temporary file first so that an interrupted write
+            # doesn't leave a partial file in the cache
+            with open(cache_file + '.tmp', 'wb') as fh:
+                fh.write(reader_gz)
+            os.replace(cache_file + '.tmp', cache_file)
+    return gzip.decompress(reader_gz).decode('utf-8')
+
+
+def fetch_reader_json_strs(reader, pmids, cache_folder=None,
+                           max_workers=None):
+    """Fetch the outputs of a reader for a list of PMIDs from S3.
+
+    The outputs are fetched by a pool of threads sharing one S3 client, and
+    are generated in the order in which they arrive so that they can be
+    processed while the next ones are fetched. Failed fetches are
+    retried s3_fetch_attempts times with exponential backoff.
+
+    Parameters
+    ----------
+    reader : str
+        The name of the reader, e.g., 'reach'.
+    pmids : list[str]
+        The PMIDs whose reader outputs are fetched.
+    cache_folder : Optional[str]
+        A folder in which the (gzipped) outputs are cached, so that outputs
+        fetched before are read from disk instead. Default: no cache.
+    max_workers : Optional[int]
+        The number of fetching threads. Default: s3_fetch_workers. At most
+        max_pending_fetches times as many outputs are fetched ahead of the
+        ones that were consumed.
+
+    Yields
+    ------
+    tuple(str, str)
+        A PMID and the reader output JSON string for that PMID, which is
+        None if there is no reader output for the PMID. PMIDs whose output
+        couldn't be fetched are left out (with a warning), so that the
+        shards they belong to aren't done and they are fetched again when
+        processing is resumed.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, \
+        FIRST_COMPLETED
+    max_workers = max_workers or s3_fetch_workers
+    client = _get_s3_client(max_workers)
+    pmids = iter(pmids)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_next():
+            for pmid in itertools.islice(pmids, 1):
+                futures[executor.submit(_fetch_reader_json_str, client,
+                                        reader, pmid, cache_folder)] = pmid
+        # Only a bounded number of outputs are fetched ahead of the ones
+        # that were consumed, so that the outputs don't pile up in memory
+        # if they are fetched faster than they are processed
+        futures = {}
+        for _ in range(max_pending_fetches * max_workers):
+            submit_next()
+        num_failed = 0
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                pmid = futures.pop(future)
+                try:
+                    json_str = future.result()
+                except Exception as e:
+                    logger.warning('Could not fetch %s output for %s: %s' %
+                                   (reader, pmid, e))
+                    num_failed += 1
+                else:
+                    yield pmid, json_str
+                submit_next()
+            # Drop the references to the consumed outputs
+            done = future = json_str = None
+    if num_failed:
+        logger.warning('Could not fetch %d %s outputs, rerun to fetch them '
+                       'again' % (num_failed, reader))
+
+
+def process_reader_outputs(reader, pmids, data_folder, processes=None):
+    """Return Statements processed from the outputs of a reader on S3.
+
+    Fetching and processing are pipelined: the reader outputs are fetched by
+    threads (see fetch_reader_json_strs) and processed into Statements by a
+    separate pool of processes as they arrive. Fetched outputs are cached in
+    the reader_output_cache folder of data_folder and the Statements are
+    written in shards of pmids_per_shard PMIDs (see ShardWriter) so that
+    an interrupted run can be resumed. If some outputs couldn't be fetched,
+    the shards they belong to aren't written and a ValueError is raised
+    once the other shards are done, and a rerun fetches them again.
+    """
+    process_fun = globals()['_process_%s_json_str' % reader]
+    cache_folder = os.path.join(data_folder, 'reader_output_cache')
+    writer = get_shard_writer(reader, data_folder, pmids, pmids_per_shard)
+    json_strs = fetch_reader_json_strs(reader, writer.pending_units(),
+                                       cache_folder)
+    return process_into_shards(process_fun, writer, json_strs, processes)
+
+
+def _process_reach_json_str(pmid_json_str):
+    pmid, reach_json_str = pmid_json_str
+    if reach_json_str is None:
+        return pmid, []
     try:
         logger.info('Processing %s' % pmid)
-        reach_json_str = s3_client.get_reader_json_str('reach', pmid)
         rp = reach.process_json_str(reach_json_str, citation=pmid)
-        return rp.statements
+        return pmid, rp.statements
     except Exception as e:
-        return []
+        return pmid, []
 
 
 def process_reach(data_folder):
-    from multiprocessing import Pool
-    pool = Pool(4)
-    stmts_ll = pool.map(_process_reach_pmid, pmids)
-    pool.close()
-    pool.join()
-    stmts = []
-    for stmts_l in stmts_ll:
-        stmts += stmts_l
-    return stmts
+    return process_reader_outputs('reach', pmids, data_folder)
 
 
 def _process_trips_fname(fname):
@@ -227,42 +676,35 @@ def _process_trips_fname(fname):
         for stmt in tp.statements:
             for ev in stmt.evidence:
                 ev.pmid = pmid
-        return tp.statements
+        return fname, tp.statements
     else:
-        return []
+        return fname, []
 
 
 def process_trips(data_folder):
-    from multiprocessing import Pool
     file_pattern = os.path.join(data_folder, 'trips', '*.ekb')
-    fnames = glob.glob(file_pattern)
-    stmts = []
-    pool = Pool(4)
-    stmts_ll = pool.map(_process_trips_fname, fnames)
-    pool.close()
-    pool.join()
-    stmts = []
-    for stmts_l in stmts_ll:
-        stmts += stmts_l
-    return stmts
+    fnames = sorted(glob.glob(file_pattern))
+    writer = get_shard_writer('trips', data_folder, fnames, files_per_shard)
+    return process_into_shards(_process_trips_fname, writer)
 
 
-def _process_sparser_pmid(pmid):
-    from indra.literature import s3_client
+def _process_sparser_json_str(pmid_json_str):
+    pmid, js = pmid_json_str
+    if js is None:
+        return pmid, []
     try:
         logger.info('Processing %s' % pmid)
-        js = s3_client.get_reader_json_str('sparser', pmid)
         jd = json.loads(js)
         sp = sparser.process_json_dict(jd)
         if sp:
             for stmt in sp.statements:
                 for ev in stmt.evidence:
                     ev.pmid = pmid
-            return sp.statements
+            return pmid, sp.statements
         else:
-            return []
+            return pmid, []
     except Exception as e:
-        return []
+        return pmid, []
 
 
 def process_sparser(data_folder):
@@ -275,37 +717,203 @@ def process_sparser(data_folder):
                               project_name='cwc')
     reading_res = wait_for_complete('run_reach_queue', job_list)
     # Step 2: re-process reading results
-    from multiprocessing import Pool
-    pool = Pool(4)
-    stmts_ll = pool.map(_process_sparser_pmid, pmids)
-    pool.close()
-    pool.join()
-    stmts = []
-    for stmts_l in stmts_ll:
-        stmts += stmts_l
-    #ground_statements(stmts)
+    stmts = process_reader_outputs('sparser', pmids, data_folder)
+    #ground_statements_batched(stmts,
+    #                          cache=get_grounding_cache(data_folder))
     return stmts
 
 
-def process_isi(data_folder):
+def _process_isi_fname(fname):
     from indra.sources import isi
-    fnames = glob.glob(os.path.join(data_folder, 'isi', 'output_amazon',
-                                    'output', '*.json'))
-    stmts = []
+    pmid = os.path.basename(fname)[:-5]
+    ip = isi.process_json_file(fname, pmid=pmid, add_grounding=False)
+    return fname, ip.statements
+
+
+def process_isi(data_folder):
+    fnames = sorted(glob.glob(os.path.join(data_folder, 'isi',
+                                           'output_amazon', 'output',
+                                           '*.json')))
     pmid_set = set(pmids)
     skipped_pmids = []
+    isi_fnames = []
     for fname in fnames:
         pmid = os.path.basename(fname)[:-5]
         # Skip PMIDs that aren't part of the PMID list
         if pmid not in pmid_set:
             skipped_pmids.append(pmid)
             continue
-        ip = isi.process_json_file(fname, pmid=pmid, add_grounding=False)
-        stmts += ip.statements
-    ground_statements(stmts)
+        isi_fnames.append(fname)
+    writer = get_shard_writer('isi', data_folder, isi_fnames,
+                              files_per_shard)
+    stmts = process_into_shards(_process_isi_fname, writer)
+    ground_statements_batched(stmts, cache=get_grounding_cache(data_folder))
     return stmts
 
 
+class GroundingCache(object):
+    """A persistent cache of Gilda groundings in an SQLite database.
+
+    Groundings are keyed by the grounded text, a hash of its context and
+    the grounder (see get_grounder), so that groundings from another
+    grounding mode or Gilda version aren't reused, and the numbers of cache
+    hits and misses are counted.
+
+    Parameters
+    ----------
+    path : str
+        The path to the SQLite database, which is created if it doesn't
+        exist.
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS grounding ('
+                          'text TEXT, context_hash TEXT, grounder TEXT, '
+                          'grounding TEXT, '
+                          'PRIMARY KEY (text, context_hash, grounder))')
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys, grounder):
+        """Return a dict of the cached groundings of (text, context) pairs
+        by a grounder and count the pairs that are not cached as misses."""
+        groundings = {}
+        for txt, context in keys:
+            res = self.conn.execute(
+                'SELECT grounding FROM grounding WHERE text = ? AND '
+                'context_hash = ? AND grounder = ?',
+                (txt, _context_hash(context), grounder)).fetchone()
+            if res is not None:
+                groundings[(txt, context)] = json.loads(res[0])
+        self.hits += len(groundings)
+        self.misses += len(keys) - len(groundings)
+        return groundings
+
+    def put_many(self, groundings, grounder):
+        """Add a dict of groundings of (text, context) pairs by a
+        grounder."""
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO grounding VALUES (?, ?, ?, ?)',
+                [(txt, _context_hash(context), grounder, json.dumps(gr))
+                 for (txt, context), gr in groundings.items()])
+
+
+def _context_hash(context):
+    return hashlib.sha1((context or '').encode('utf-8')).hexdigest()
+
+
+def get_grounder(mode):
+    """Return the grounding mode and the version of Gilda used by it.
+
+    In web mode, the version is that of the Gilda web service used by
+    INDRA's get_grounding, in local mode, that of the gilda package.
+    """
+    if mode == 'web':
+        from urllib.parse import urljoin
+        from indra.preassembler.grounding_mapper.gilda import \
+            grounding_service_url
+        with urllib.request.urlopen(
+                urljoin(grounding_service_url, 'version')) as res:
+            version = res.read().decode('utf-8').strip()
+    else:
+        import gilda
+        version = gilda.__version__
+    return '%s:%s' % (mode, version)
+
+
+def get_grounding_cache(data_folder):
+    """Return the grounding cache shared by the sources in a data folder."""
+    return GroundingCache(os.path.join(data_folder, 'grounding_cache.db'))
+
+
+def ground_statements_batched(stmts, mode='web', processes=None,
+                              batch_size=1000, cache=None):
+    """Ground the Agents of Statements with Gilda in parallel batches.
+
+    This is equivalent to INDRA's gilda ground_statements, except that
+    each distinct (text, context) pair is only grounded once, and the
+    distinct pairs are grounded in batches by a pool of processes. The
+    Statements are modified in place.
+
+    Parameters
+    ----------
+    stmts : list[indra.statements.Statement]
+        The Statements whose Agents are grounded. As in ground_statements,
+        the text of the first evidence is used as context.
+    mode : Optional[str]
+        'web' to use the Gilda web service, 'local' to use the gilda
+        package. Default: web
+    processes : Optional[int]
+        The number of processes grounding batches. Default:
+        get_num_processes(worker_memory)
+    batch_size : Optional[int]
+        The number of (text, context) pairs per batch. Default: 1000
+    cache : Optional[GroundingCache]
+        A persistent cache of groundings. If given, only the pairs that
+        are not in the cache for the grounding mode and Gilda version
+        are grounded, and their groundings are added to the cache as
+        batches finish.
+
+    Returns
+    -------
+    list[indra.statements.Statement]
+        The grounded Statements.
+    """
+    from functools import partial
+    from multiprocessing import Pool
+    from indra.ontology.standardize import standardize_agent_name
+    agent_keys = []
+    for stmt in stmts:
+        if stmt.evidence and stmt.evidence[0].text:
+            context = stmt.evidence[0].text
+        else:
+            context = None
+        for agent in stmt.agent_list():
+            if agent is not None and 'TEXT' in agent.db_refs:
+                agent_keys.append((agent, (agent.db_refs['TEXT'], context)))
+
+    # Ground each distinct (text, context) pair once, the groundings are
+    # shared by all batches
+    keys = list(dict.fromkeys(key for _, key in agent_keys))
+    groundings = {}
+    if cache is not None:
+        grounder = get_grounder(mode)
+        groundings = cache.get_many(keys, grounder)
+    keys = [key for key in keys if key not in groundings]
+    batches = [keys[ix:ix+batch_size]
+               for ix in range(0, len(keys), batch_size)]
+    logger.info('Grounding %d distinct texts of %d agents in %d batches' %
+                (len(keys), len(agent_keys), len(batches)))
+    with Pool(processes or get_num_processes(worker_memory)) as pool:
+        for batch, batch_groundings in \
+                zip(batches, pool.imap(partial(_ground_batch, mode=mode),
+                                       batches)):
+            batch_groundings = dict(zip(batch, batch_groundings))
+            groundings.update(batch_groundings)
+            if cache is not None:
+                cache.put_many(batch_groundings, grounder)
+    if cache is not None:
+        logger.info('Grounding cache %s: %d hits, %d misses' %
+                    (cache.path, cache.hits, cache.misses))
+
+    for agent, (txt, context) in agent_keys:
+        gr = groundings[(txt, context)]
+        if gr:
+            db_refs = {'TEXT': txt}
+            db_refs.update(gr)
+            agent.db_refs = db_refs
+            standardize_agent_name(agent, standardize_refs=True)
+    return stmts
+
+
+def _ground_batch(keys, mode):
+    from indra.preassembler.grounding_mapper.gilda import get_grounding
+    return [get_grounding(txt, context, mode)[0] for txt, context in keys]
+
+
 if __name__ == '__main__':
     data_folder = sys.argv[1]
     target_folder = sys.argv[2]
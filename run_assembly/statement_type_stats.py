@@ -3,10 +3,9 @@ before normalization or filtering, i.e., at the level of raw Statements."""
 
 import csv
 from collections import defaultdict, Counter
-import pickle
+from bioexp.pickle_io import load_pickle
 
-with open('bioexp_all_raw.pkl', 'rb') as fh:
-    stmts = pickle.load(fh)
+stmts = load_pickle('bioexp_all_raw.pkl')
 
 stmt_type_by_source = defaultdict(list)
 for stmt in stmts:
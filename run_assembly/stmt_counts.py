@@ -1,6 +1,9 @@
-from util import pklload
-from indra.tools import assemble_corpus as ac
+import os
+import sys
+from util import prefixed_pkl, load_pickle
+from bioexp.memory import get_num_processes
 from collections import Counter
+from multiprocessing import get_context
 
 # Reader sources
 readers = ['reach', 'sparser', 'medscan', 'rlimsp',
@@ -18,59 +21,120 @@ asmb = ['all_raw', 'filter_no_hypothesis', 'map_grounding',
 # All together now
 filenames = sources + asmb
 
-if __name__ == '__main__':
-    stmt_counts = []
-    for filename in filenames:
-        # Load the pickle file
+# The UUIDs of the CBN statements, which are used to figure out which
+# evidences are from CBN in other files. They are loaded before the worker
+# processes are forked so that they are shared with them.
+cbn_uuids = set()
+
+
+def get_stmts_file(filename):
+    """Return the path to the statement pickle of a source or assembly step."""
+    if filename in ('reach', 'sparser', 'pathway_commons'):
+        return '../data/bioexp_%s.pkl' % filename
+    return prefixed_pkl(filename)
+
+
+def count_ev_sources(filename, stmts=None):
+    """Count the combinations of evidence sources of the statements in a file.
+
+    Returns the name of the file, its number of statements and a Counter
+    of the sets of evidence sources of its statements, as comma-separated
+    strings.
+    """
+    if stmts is None:
         print("Loading %s" % filename)
-        if filename in ('reach', 'sparser', 'pathway_commons'):
-            stmts = ac.load_statements('../data/bioexp_%s.pkl' % filename)
-        else:
-            stmts = pklload(filename)
-        # We get the CBN UUIDs here so we can figure out later which
-        # evidences are from CBN later
-        if filename == 'cbn':
-            cbn_uuids = {stmt.uuid for stmt in stmts}
-        # Tabulate evidence source combinations
-        ev_types = []
-        for s in stmts:
-            source_apis = []
-            for e in s.evidence:
-                # We use the evidence source_api by default
-                source_api = e.source_api
-                # We have to do some special handling for CBN here, if the
-                # statements are already assembled, we have to look at
-                # evidence prior UUID to check if they are originally from CBN
-                if filename == 'cbn':
-                    source_api = 'cbn'
-                elif e.source_api == 'bel' and filename != 'bel':
-                    if filename == 'asmb_preassembled':
-                        if set(e.annotations.get('prior_uuids', set())) & \
-                                cbn_uuids:
-                            source_api = 'cbn'
-                    # Otherwise we look at the statement's UUID (only available
-                    # here before assembly) to see if it's originally from CBN
-                    else:
-                        if s.uuid in cbn_uuids:
-                            source_api = 'cbn'
-                # We can now check if the source sub ID is phosphositeplus
-                # which we need to separate from biopax
-                if e.annotations.get('source_sub_id') == 'phosphositeplus':
-                    source_api = 'phosphosite'
-                source_apis.append(source_api)
-            source_apis = frozenset(source_apis)
-            ev_types.append(source_apis)
-        ev_ctr = Counter(ev_types)
-        print("%s stmts in %s" % (len(stmts), filename))
-        stmt_counts.append((filename, len(stmts), ev_ctr))
-        print(stmt_counts)
-        del stmts
+        stmts = load_pickle(get_stmts_file(filename))
+    # Tabulate evidence source combinations
+    ev_ctr = Counter()
+    for s in stmts:
+        source_apis = []
+        for e in s.evidence:
+            # We use the evidence source_api by default
+            source_api = e.source_api
+            # We have to do some special handling for CBN here, if the
+            # statements are already assembled, we have to look at
+            # evidence prior UUID to check if they are originally from CBN
+            if filename == 'cbn':
+                source_api = 'cbn'
+            elif e.source_api == 'bel' and filename != 'bel':
+                if filename == 'asmb_preassembled':
+                    if set(e.annotations.get('prior_uuids', set())) & \
+                            cbn_uuids:
+                        source_api = 'cbn'
+                # Otherwise we look at the statement's UUID (only available
+                # here before assembly) to see if it's originally from CBN
+                else:
+                    if s.uuid in cbn_uuids:
+                        source_api = 'cbn'
+            # We can now check if the source sub ID is phosphositeplus
+            # which we need to separate from biopax
+            if e.annotations.get('source_sub_id') == 'phosphositeplus':
+                source_api = 'phosphosite'
+            source_apis.append(source_api)
+        ev_ctr[frozenset(source_apis)] += 1
+    print("%s stmts in %s" % (len(stmts), filename))
+    # The sets are joined here since the order of their elements could
+    # change when they are pickled and sent to the parent process
+    ev_ctr = Counter({','.join(ev_set): ev_count
+                      for ev_set, ev_count in ev_ctr.items()})
+    return filename, len(stmts), ev_ctr
+
+
+# A rough estimate of the memory taken up by the statements loaded from a
+# pickle, per byte of the (uncompressed) pickle file
+memory_per_pickle_byte = 10
+
+
+def get_stmt_counts(processes=None):
+    """Return the statement and evidence source counts of all files in
+    order.
+
+    The files are counted in parallel, with each worker process loading
+    one file at a time, largest files first. Since the largest files are
+    then loaded at the same time, this takes up to `processes` times as
+    much memory as counting them one at a time, so the number of processes
+    is limited so that the largest file fits into the available memory once
+    per process (see memory_per_pickle_byte). If this only leaves one
+    process, the files are counted one at a time in this process.
+
+    Parameters
+    ----------
+    processes : Optional[int]
+        The maximum number of processes. Default: the number of cores
+    """
+    # We get the CBN UUIDs here so we can figure out later which
+    # evidences are from CBN
+    print("Loading cbn")
+    stmts = load_pickle(get_stmts_file('cbn'))
+    cbn_uuids.update(stmt.uuid for stmt in stmts)
+    stmt_counts = {'cbn': count_ev_sources('cbn', stmts)}
+    del stmts
+    other_files = sorted([f for f in filenames if f != 'cbn'],
+                         key=lambda f: os.path.getsize(get_stmts_file(f)),
+                         reverse=True)
+    file_memory = memory_per_pickle_byte * \
+        os.path.getsize(get_stmts_file(other_files[0]))
+    processes = get_num_processes(file_memory, processes)
+    if processes > 1:
+        print("Counting with %d processes" % processes)
+        with get_context('fork').Pool(processes) as pool:
+            for res in pool.imap_unordered(count_ev_sources, other_files):
+                stmt_counts[res[0]] = res
+    else:
+        for filename in other_files:
+            stmt_counts[filename] = count_ev_sources(filename)
+    return [stmt_counts[filename] for filename in filenames]
+
+
+if __name__ == '__main__':
+    # The maximum number of files to count in parallel can be given as an
+    # argument
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    stmt_counts = get_stmt_counts(processes)
 
     # Write to TSV file with comma-separated sources in each row
     with open('../output/fig2_stmt_counts.txt', 'wt') as f:
         for filename, count, ev_ctr in stmt_counts:
             f.write('%s\ttotal\t%s\n' % (filename, count))
-            for ev_set, ev_count in ev_ctr.items():
-                ev_key = ','.join(ev_set)
+            for ev_key, ev_count in ev_ctr.items():
                 f.write('%s\t%s\t%s\n' % (filename, ev_key, ev_count))
-
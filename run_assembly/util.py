@@ -2,7 +2,7 @@ from indra.util import _require_python3
 import os
 import json
 import time
-import pickle
+from bioexp.pickle_io import dump_pickle, dump_pickle_chunks, load_pickle
 
 # CREATE A JSON FILE WITH THIS INFORMATION, E.G., a file consisting of:
 # {"basename": "fallahi_eval", "basedir": "output"}
@@ -14,6 +14,9 @@ basen = config['basename']
 # This is the base folder to read/write (potentially large) files from/to
 # MODIFY ACCORDING TO YOUR OWN SETUP
 based = config['basedir']
+# The compression of the pickle files written by pkldump, which can be set
+# to 'zstd' or 'lz4' by an optional "pkl_compression" entry
+pkl_compression = config.get('pkl_compression')
 
 
 # This makes it easier to make standardized pickle file paths
@@ -28,11 +31,15 @@ def prefixed_file(suffix, extension):
 
 
 
-def pkldump(content, suffix):
-    """Dump content into a pickle file based on a name suffix"""
+def pkldump(content, suffix, compression=None):
+    """Dump content into a pickle file based on a name suffix
+
+    The file is compressed as given by compression ('zstd', 'lz4' or
+    'none'), or by pkl_compression if compression is None (see
+    bioexp.pickle_io.dump_pickle).
+    """
     fname = prefixed_pkl(suffix)
-    with open(fname, 'wb') as fh:
-        pickle.dump(content, fh)
+    dump_pickle(content, fname, compression or pkl_compression)
 
 
 def pklload(suffix):
@@ -40,8 +47,7 @@ def pklload(suffix):
     fname = prefixed_pkl(suffix)
     print('Loading %s' % fname)
     ts = time.time()
-    with open(fname, 'rb') as fh:
-        content = pickle.load(fh)
+    content = load_pickle(fname)
     te = time.time()
     print('Loaded %s in %.1f seconds' % (fname, te-ts))
     return content